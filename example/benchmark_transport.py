@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Compare the remote calls performance over loopback TCP and a Unix domain socket.
+
+Start the API binding both a TCP port and a Unix domain socket, for example::
+
+    $ gunicorn "example:get_app('example.ini')" -k gevent -w 4 \\
+        -b 127.0.0.1:8001 -b unix:/tmp/smapy.sock
+
+And then run this script::
+
+    $ python benchmark_transport.py --calls 10000 --concurrency 50
+"""
+
+import argparse
+import time
+
+from gevent import monkey    # noqa isort:skip
+monkey.patch_all()    # noqa isort:skip
+
+import requests    # noqa: E402
+from bson import ObjectId, json_util    # noqa: E402
+from gevent.pool import Pool    # noqa: E402
+
+from smapy.transport import UNIX_URL, UnixAdapter, get_url    # noqa: E402
+
+
+def benchmark(endpoint, calls, concurrency, runnable):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount(UNIX_URL, UnixAdapter(pool_maxsize=concurrency, pool_block=True))
+
+    url = get_url(endpoint) + '/_remote'
+    headers = {'API-SESSION': str(ObjectId())}
+    data = json_util.dumps({
+        'runnable': runnable,
+        'message': {}
+    })
+
+    def call(_):
+        start = time.monotonic()
+        response = session.post(url, data=data, headers=headers)
+        response.raise_for_status()
+        return time.monotonic() - start
+
+    start = time.monotonic()
+    latencies = sorted(Pool(concurrency).imap_unordered(call, range(calls)))
+    elapsed = time.monotonic() - start
+
+    return {
+        'calls/s': round(calls / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remote transport benchmark')
+    parser.add_argument('--tcp', default='http://127.0.0.1:8001')
+    parser.add_argument('--unix', default='unix:///tmp/smapy.sock')
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--runnable', default='hello.World')
+
+    args = parser.parse_args()
+
+    for endpoint in (args.tcp, args.unix):
+        results = benchmark(endpoint, args.calls, args.concurrency, args.runnable)
+        print(endpoint, results)
+
+
+if __name__ == '__main__':
+    main()
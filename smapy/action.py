@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import random
 import sys
 import traceback
 from abc import abstractmethod
 
-from smapy import utils
+from smapy import executors, utils
 from smapy.runnable import Runnable
 
 
@@ -14,26 +15,85 @@ class BaseAction(Runnable):
     audit = True    # If False, skip audit insert
     initial_message = None
 
+    # Audit policies. If None, the one of the invoking resource or the global one is used
+    audit_sample_rate = None    # Fraction of the calls to audit
+    audit_exceptions = None    # If True, always audit the calls which raise an exception
+    audit_slow_ms = None    # Always audit the calls which last at least these milliseconds
+
+    cpu_bound = False    # If True, run process in the process pool of the worker
+
+    tracked_message = None
+
     def copy_message(self, message):
+        """Keep a copy of the initial message and return the message to be processed.
+
+        If the [audit] snapshot conf is ``lazy``, instead of deep copying the whole
+        message upfront, a TrackedDict which only copies the values accessed by
+        the action is returned, and the initial message is rebuilt from it if needed.
+        Messages which are already a TrackedDict are used as they are.
+        """
         self.initial_message = dict()
+        if isinstance(message, utils.TrackedDict):
+            # Already tracked, such as the remote messages in delta mode
+            self.tracked_message = message
+            return message
+
+        if self.cpu_bound and isinstance(message, dict):
+            # process gets a pickled copy, so the values of message are never mutated
+            self.initial_message = dict(message)
+            return message
+
+        if isinstance(message, dict) and self._get_audit_conf('snapshot') == 'lazy':
+            self.tracked_message = utils.TrackedDict(message)
+            return self.tracked_message
+
         try:
             self.initial_message = utils.safecopy(message)
 
         except RuntimeError as rerror:
             self.logger.error('Could not copy initial message: %s', rerror)
 
-    def insert_audit(self):
+        return message
+
+    def get_initial_message(self):
+        if self.tracked_message is not None:
+            try:
+                self.initial_message = self.tracked_message.original()
+
+            except RuntimeError as rerror:
+                self.logger.error('Could not copy initial message: %s', rerror)
+
+        return self.initial_message
+
+    def _get_audit_conf(self, key):
+        return (self.conf.get('audit') or dict()).get(key)
+
+    def get_audit_policy(self, policy):
+        """Get an audit policy from the action, the invoking resource or the [audit] conf."""
+        value = getattr(self, 'audit_' + policy)
+        if value is None:
+            value = self.context.get('audit_' + policy)
+
+        if value is None:
+            value = self._get_audit_conf(policy)
+
+        return value
+
+    def _is_sampled(self):
+        sample_rate = self.get_audit_policy('sample_rate')
+        return sample_rate is None or random.random() < float(sample_rate)
+
+    def _start_audit(self):
         self.start_ts = datetime.datetime.utcnow()
 
-        audit = {
+        return {
             'action': self.name,
             'session': self.session,
             'start_ts': self.start_ts,
             'status': 'RUNNING'
         }
-        self.aid = self.auditdb.actions.insert(audit)
 
-    def update_audit(self, message, exception):
+    def _end_audit(self, message, exception):
         end_ts = datetime.datetime.utcnow()
 
         audit = {
@@ -43,24 +103,56 @@ class BaseAction(Runnable):
         if exception:
             audit['status'] = 'EXCEPTION'
             audit['exception'] = exception
-            audit['request'] = self.initial_message
+            audit['request'] = self.get_initial_message()
             audit['message'] = message
 
         else:
             audit['status'] = 'OK'
 
-        match = {'_id': self.aid}
-        update = {'$set': audit}
-        self.auditdb.actions.update(match, update)
+        return audit
+
+    def insert_audit(self):
+        self.aid = self.audit_writer.start(self._start_audit())
+
+    def update_audit(self, message, exception):
+        self.audit_writer.finish(self.aid, self._end_audit(message, exception))
+
+    def write_audit(self, audit, message, exception):
+        """Write the whole audit of a call which was not sampled if a policy requires it."""
+        audit.update(self._end_audit(message, exception))
+
+        slow_ms = self.get_audit_policy('slow_ms')
+        if exception and self.get_audit_policy('exceptions'):
+            self.audit_writer.insert(audit)
+
+        elif slow_ms is not None and audit['elapsed'] >= float(slow_ms):
+            self.audit_writer.insert(audit)
 
     def run_local(self, message):
-        if self.audit and self.context.get('audit', True):
+        audit = self.audit and self.context.get('audit', True)
+        sampled = audit and self._is_sampled()
+        processed = message
+        if sampled:
             self.insert_audit()
-            self.copy_message(message)
+            processed = self.copy_message(message)
+
+        elif audit:
+            # Not sampled, so it will only be audited, with a single write
+            # once finished, if an exception or slow_ms policy requires it
+            unsampled_audit = self._start_audit()
+            if self.get_audit_policy('exceptions'):
+                processed = self.copy_message(message)
 
         exception = None
         try:
-            self.process(message)
+            if self.cpu_bound:
+                self.process_in_pool(processed)
+
+            elif self.blocking:
+                self.process_in_thread(processed)
+
+            else:
+                self.process(processed)
 
         except BaseException as e:
             self.logger.exception("Caught an uncontrolled Exception")
@@ -69,9 +161,29 @@ class BaseAction(Runnable):
                 raise
 
         finally:
-            if self.audit and self.context.get('audit', True):
+            if processed is not message:
+                # Only bring back the changes, since other runnables may share the message
+                utils.apply_delta(message, processed.get_delta())
+
+            if sampled:
                 self.update_audit(message, exception)
 
+            elif audit:
+                self.write_audit(unsampled_audit, message, exception)
+
+    def process_in_pool(self, message):
+        """Run process in the process pool of the worker and merge back the results.
+
+        Only the message is available to the process method of cpu_bound
+        actions, which must be picklable, as well as the action class.
+        """
+        max_workers = self.conf['api'].get('process_pool_size')
+        original = dict(dict.items(message))
+        processed = executors.run_in_process(type(self), original, max_workers)
+
+        # Only bring back the changes, since other runnables may share the message
+        utils.apply_delta(message, utils.get_delta(original, processed))
+
     @abstractmethod
     def process(self, message):
         """The actual action code should be implemented here by subclasses."""
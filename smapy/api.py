@@ -1,20 +1,71 @@
 # -*- coding: utf-8 -*-
 
+import atexit
 import importlib
 import logging
 import traceback
 
 import falcon
-from pymongo import MongoClient
+import gevent
+from pymongo import ASCENDING, DESCENDING, MongoClient, WriteConcern
+from pymongo.database import Database
+from pymongo.errors import ConnectionFailure, PyMongoError
 
 from smapy import resources
 from smapy.action import BaseAction
+from smapy.audit import (
+    BulkMongoAuditWriter, LogAuditWriter, MongoAuditWriter, NullAuditWriter, SqliteAuditWriter)
+from smapy.capture import SessionCapture
 from smapy.middleware import JSONSerializer, ResponseBuilder
-from smapy.runnable import RemoteRunnable
+from smapy.runnable import RemoteRunnable, Runnable
 from smapy.utils import find_submodules
 
 LOGGER = logging.getLogger(__name__)
 
+AUDIT_MODES = ('update', 'single')
+AUDIT_BACKENDS = ('mongo', 'log', 'sqlite', 'null')
+
+
+class WriteConcernDatabase(Database):
+    """MongoDB database which applies a different write concern to some collections.
+
+    ``write_concerns`` maps the collection names to the WriteConcern arguments.
+    The bucketed collections, such as ``actions_20180101`` or ``actions_2018_w01``,
+    use the write concern of their prefix, unless they have their own.
+    """
+
+    def __init__(self, client, name, write_concerns):
+        super().__init__(client, name)
+        self.write_concerns = {
+            collection: WriteConcern(**options)
+            for collection, options in write_concerns.items()
+        }
+
+    def _get_write_concern(self, name):
+        write_concern = self.write_concerns.get(name)
+        if write_concern is None:
+            prefixes = [
+                collection for collection in self.write_concerns
+                if name.startswith(collection + '_')
+            ]
+            if prefixes:
+                write_concern = self.write_concerns[max(prefixes, key=len)]
+
+        return write_concern
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def get_collection(self, name, codec_options=None, read_preference=None,
+                       write_concern=None, read_concern=None):
+        return super().get_collection(
+            name,
+            codec_options=codec_options,
+            read_preference=read_preference,
+            write_concern=write_concern or self._get_write_concern(name),
+            read_concern=read_concern
+        )
+
 
 class Request(falcon.Request):
     body = None
@@ -43,6 +94,15 @@ def import_object(object_name):
 
 class API(falcon.API):
 
+    # (database, collection, keys, options) of the indexes used by the default resources
+    INDEXES = [
+        ('mongodb', 'session', [('resource', ASCENDING), ('_id', DESCENDING)], {}),
+        ('auditdb', 'actions', [('session', ASCENDING), ('_id', DESCENDING)], {}),
+        ('mongodb', 'links', [('session', ASCENDING), ('update_ts', ASCENDING)], {}),
+        ('mongodb', 'post', [('session', ASCENDING), ('update_ts', ASCENDING)], {}),
+        ('mongodb', 'occurrences', [('session', ASCENDING), ('update_ts', ASCENDING)], {}),
+    ]
+
     @staticmethod
     def _is_action(obj, module):
         if not isinstance(obj, type):
@@ -103,24 +163,175 @@ class API(falcon.API):
         self._add_runnable(resource_class, route=route, **kwargs)
         self.add_route(route, resource_class)
 
+    def _get_client(self, host, port, options):
+        """Get a MongoClient, sharing it between databases with the same settings."""
+        key = (host, port, repr(sorted(options.items())))
+        client = self.mongo_clients.get(key)
+        if client is None:
+            client = MongoClient(host=host, port=port, connect=False, **options)
+            self.mongo_clients[key] = client
+
+        return client
+
     def _get_mongodb(self, conf):
         host = conf.get('host', '127.0.0.1')
         port = conf.get('port', 27017)
         database = conf.get('database', 'smapy')
 
-        client = MongoClient(host=host, port=port, connect=False)
+        client = self._get_client(host, port, conf.get('client_options') or dict())
+
+        write_concerns = conf.get('write_concerns')
+        if write_concerns:
+            return WriteConcernDatabase(client, database, write_concerns)
+
         return client[database]
 
     def _set_mongodb_up(self, conf):
+        self.mongo_clients = dict()
         self.mongodb = self._get_mongodb(conf['mongodb'])
 
         audit_conf = conf.get('audit')
-        if audit_conf:
+        if audit_conf and any(key in audit_conf for key in ('host', 'port', 'database')):
             self.auditdb = self._get_mongodb(audit_conf)
 
+        elif audit_conf and audit_conf.get('write_concerns'):
+            # Same database, but with the audit write concerns
+            mongodb_conf = dict(conf['mongodb'], write_concerns=audit_conf['write_concerns'])
+            self.auditdb = self._get_mongodb(mongodb_conf)
+
         else:
             self.auditdb = self.mongodb
 
+        # Do not block the worker startup on MongoDB, which may be unreachable
+        indexes = self.INDEXES + self._get_conf_indexes(conf)
+        create = conf['mongodb'].get('ensure_indexes', True)
+        self.indexes_greenlet = gevent.spawn(self._ensure_indexes, indexes, create)
+
+    @staticmethod
+    def _get_conf_indexes(conf):
+        """Indexes required by the features enabled in the conf.
+
+        These are the TTL indexes that expire the old sessions and, if not
+        bucketed, action audits, and the indexes of the action rollups, which
+        expire by their last update.
+        """
+        indexes = list()
+
+        session_ttl = conf['mongodb'].get('session_ttl')
+        if session_ttl:
+            options = {'expireAfterSeconds': int(session_ttl)}
+            indexes.append(('mongodb', 'session', [('in_ts', ASCENDING)], options))
+
+        audit_conf = conf.get('audit') or dict()
+        actions_ttl = audit_conf.get('actions_ttl')
+        if actions_ttl and not audit_conf.get('bucket'):
+            options = {'expireAfterSeconds': int(actions_ttl)}
+            indexes.append(('auditdb', 'actions', [('start_ts', ASCENDING)], options))
+
+        if audit_conf.get('rollups'):
+            keys = [('session', ASCENDING), ('action', ASCENDING)]
+            indexes.append(('auditdb', MongoAuditWriter.ROLLUPS, keys, {'unique': True}))
+            if actions_ttl:
+                options = {'expireAfterSeconds': int(actions_ttl)}
+                keys = [('update_ts', ASCENDING)]
+                indexes.append(('auditdb', MongoAuditWriter.ROLLUPS, keys, options))
+
+        return indexes
+
+    @staticmethod
+    def _has_index(collection, keys):
+        return any(
+            [tuple(key) for key in index['key']] == keys
+            for index in collection.index_information().values()
+        )
+
+    def _ensure_indexes(self, indexes, create=True):
+        """Create the given indexes, or only check them if create is False.
+
+        Return the list of the indexes that are missing, which are also logged.
+        If MongoDB cannot be reached, the remaining indexes are not tried.
+        """
+        missing = list()
+        unreachable = False
+        for database, collection, keys, options in indexes:
+            collection = getattr(self, database)[collection]
+            if unreachable:
+                missing.append((collection.full_name, keys))
+                continue
+
+            try:
+                if create:
+                    collection.create_index(keys, background=True, **options)
+
+                elif not self._has_index(collection, keys):
+                    missing.append((collection.full_name, keys))
+
+            except ConnectionFailure as error:
+                LOGGER.error('Could not ensure the indexes, MongoDB is unreachable: %s', error)
+                unreachable = True
+                missing.append((collection.full_name, keys))
+
+            except PyMongoError as error:
+                LOGGER.error('Could not ensure index %s on %s: %s',
+                             keys, collection.full_name, error)
+                missing.append((collection.full_name, keys))
+
+        for name, keys in missing:
+            LOGGER.warning('Missing index %s on %s', keys, name)
+
+        return missing
+
+    def _set_audit_writer_up(self, conf):
+        audit_conf = conf.get('audit') or dict()
+
+        mode = audit_conf.get('mode', 'update')
+        if mode not in AUDIT_MODES:
+            raise ValueError('Invalid audit mode: {}'.format(mode))
+
+        backend = audit_conf.get('backend', 'mongo')
+        if backend not in AUDIT_BACKENDS:
+            raise ValueError('Invalid audit backend: {}'.format(backend))
+
+        single = mode == 'single'
+        if backend == 'null':
+            self.audit_writer = NullAuditWriter(single=single)
+
+        elif backend == 'log':
+            self.audit_writer = LogAuditWriter(
+                audit_conf.get('path', 'audit-{pid}.log'),
+                max_bytes=audit_conf.get('max_bytes', 100 * 1024 * 1024),
+                backup_count=audit_conf.get('backup_count', 5),
+                single=single,
+            )
+
+        elif backend == 'sqlite':
+            self.audit_writer = SqliteAuditWriter(
+                audit_conf.get('path', 'audit-{pid}.sqlite'), single=single)
+
+        else:
+            self.audit_writer = self._get_mongo_audit_writer(audit_conf, single)
+
+        # Do not lose the buffered audit documents on shutdown
+        atexit.register(self.audit_writer.close)
+
+    def _get_mongo_audit_writer(self, audit_conf, single):
+        kwargs = {
+            'single': single,
+            'bucket': audit_conf.get('bucket'),
+            'ttl': audit_conf.get('actions_ttl'),
+            'rollups': bool(audit_conf.get('rollups', False)),
+        }
+        if audit_conf.get('write_behind'):
+            return BulkMongoAuditWriter(
+                self.auditdb,
+                bulk_size=audit_conf.get('bulk_size', 1000),
+                flush_interval=audit_conf.get('flush_interval', 1),
+                max_size=audit_conf.get('max_buffer_size'),
+                **kwargs
+            )
+
+        return MongoAuditWriter(self.auditdb, **kwargs)
+
     def _load_default_resources(self, prefix=''):
         self.add_resource(prefix + '/multi_process', resources.misc.MultiProcess)
         self.add_resource(prefix + '/report', resources.misc.Report)
@@ -134,9 +345,17 @@ class API(falcon.API):
     def __init__(self, conf):
         self.conf = conf
         self._set_mongodb_up(conf)
+        self._set_audit_writer_up(conf)
+        self.session_capture = SessionCapture.from_conf(conf['api'], self.mongodb)
+
+        threadpool_size = conf['api'].get('threadpool_size')
+        if threadpool_size:
+            # Used by the blocking runnables and to wait for the cpu_bound actions
+            gevent.get_hub().threadpool.maxsize = int(threadpool_size)
 
         middleware = [
-            JSONSerializer(),
+            JSONSerializer(conf['api'].get('compress_min_size', 1024),
+                           conf['api'].get('compress_level', 1)),
             ResponseBuilder(),
         ]
         super(API, self).__init__(request_type=Request, middleware=middleware)
@@ -149,6 +368,9 @@ class API(falcon.API):
         RemoteRunnable.init(self)
         self.add_route(RemoteRunnable.route, RemoteRunnable)
 
+        if conf['api'].get('session_alive_broadcast'):
+            gevent.spawn(Runnable.watch_sessions, self.mongodb)
+
         self.runnables = dict()
         if conf['api'].get('default_actions', True):
             self.load_actions('smapy.actions')
@@ -23,6 +23,13 @@ class SmapyApplication(BaseApplication):
         if not api_config.get('endpoint'):
             api_config['endpoint'] = 'http://' + api_config['bind']
 
+        remote_socket = api_config.get('remote_socket')
+        if remote_socket:
+            # Also bind to a Unix domain socket and use it for the remote calls
+            # done within this host, skipping the TCP stack.
+            api_config['bind'] = [api_config['bind'], 'unix:' + remote_socket]
+            api_config.setdefault('remote_endpoints', ['unix://' + remote_socket])
+
         return config
 
     def __init__(self, config_file):
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import os
+import sqlite3
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+import gevent
+from bson import BSON, ObjectId, decode_file_iter
+from gevent.lock import Semaphore
+from pymongo import ASCENDING, DESCENDING, InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AuditWriter(metaclass=ABCMeta):
+    """Base class of the writers used by the actions to store their audits.
+
+    By default, a RUNNING audit document is inserted when an action starts and
+    updated when it finishes. In ``single`` write mode, the running actions are
+    only kept in memory, in the ``running`` registry of this worker, and a
+    single complete audit document is inserted when they finish.
+    """
+
+    rollups = False
+
+    def __init__(self, single=False):
+        self.single = single
+        self.running = dict()
+
+    @abstractmethod
+    def insert(self, audit):
+        """Insert a new audit document and return its _id."""
+
+    @abstractmethod
+    def update(self, aid, audit):
+        """Set the given values into an existing audit document."""
+
+    def start(self, audit):
+        """Record the start of an action and return its audit id."""
+        if not self.single:
+            return self.insert(audit)
+
+        audit['_id'] = ObjectId()
+        self.running[audit['_id']] = audit
+        return audit['_id']
+
+    def finish(self, aid, audit):
+        """Record the end of an action, setting the given values into its audit."""
+        if not self.single:
+            self.update(aid, audit)
+            return
+
+        running = self.running.pop(aid)
+        running.update(audit)
+        self.insert(running)
+
+    def get_running(self, session):
+        """Audits of the actions of the given session running in this worker, in single mode."""
+        return [audit for audit in self.running.values() if audit['session'] == session]
+
+    def get_collections(self, start, end=None):
+        """MongoDB collections which may hold the audits of the actions started
+        between start and end, if the audits are stored in MongoDB."""
+        return []
+
+    def flush(self):
+        """Write any pending audit document."""
+
+    def close(self):
+        self.flush()
+
+
+class NullAuditWriter(AuditWriter):
+    """Discard the audit documents."""
+
+    def insert(self, audit):
+        return audit.get('_id') or ObjectId()
+
+    def update(self, aid, audit):
+        pass
+
+
+def get_worker_path(path):
+    """Path of the file of this worker, replacing the {pid} placeholder, if any."""
+    return path.format(pid=os.getpid())
+
+
+class LogAuditWriter(AuditWriter):
+    """Append the audit writes to a local binary log file.
+
+    Each insert or update is appended as a BSON document with the ``op``,
+    the audit ``_id`` and the ``audit`` values. Use a ``{pid}`` placeholder
+    in the ``path`` to write a different file from each worker. When the file
+    reaches ``max_bytes``, it is rotated, keeping ``backup_count`` old files.
+    The log can be read back using ``LogAuditWriter.read``.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backup_count=5, single=False):
+        super().__init__(single)
+        self.path = get_worker_path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = open(self.path, 'ab')
+
+    def _rotate(self):
+        self.file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self.path, index)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self.path, index + 1))
+
+        if self.backup_count:
+            os.replace(self.path, self.path + '.1')
+
+        else:
+            os.remove(self.path)
+
+        self.file = open(self.path, 'ab')
+
+    def _append(self, op, aid, audit):
+        self.file.write(BSON.encode({'op': op, '_id': aid, 'audit': audit}))
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def insert(self, audit):
+        audit.setdefault('_id', ObjectId())
+        self._append('insert', audit['_id'], audit)
+        return audit['_id']
+
+    def update(self, aid, audit):
+        self._append('update', aid, audit)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        """Iterate over the writes stored in an audit log file."""
+        with open(path, 'rb') as log:
+            yield from decode_file_iter(log)
+
+
+class SqliteAuditWriter(AuditWriter):
+    """Write the audit documents into a local SQLite database.
+
+    Use a ``{pid}`` placeholder in the ``path`` to write a different database
+    from each worker. The main audit fields are stored in their own columns,
+    and the rest, such as the exception details, as a BSON document.
+    """
+
+    COLUMNS = ('action', 'session', 'status', 'start_ts', 'end_ts', 'elapsed')
+    CREATE = (
+        'CREATE TABLE IF NOT EXISTS actions ('
+        'id TEXT PRIMARY KEY, action TEXT, session TEXT, status TEXT, '
+        'start_ts TIMESTAMP, end_ts TIMESTAMP, elapsed REAL, extra BLOB)'
+    )
+
+    def __init__(self, path, single=False):
+        super().__init__(single)
+        self.path = get_worker_path(path)
+        self.connection = sqlite3.connect(self.path, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(self.CREATE)
+
+    def _get_values(self, audit):
+        values = {
+            key: str(value) if isinstance(value, ObjectId) else value
+            for key, value in audit.items()
+            if key in self.COLUMNS
+        }
+        extra = {key: value for key, value in audit.items() if key not in self.COLUMNS}
+        extra.pop('_id', None)
+        if extra:
+            values['extra'] = BSON.encode(extra)
+
+        return values
+
+    def insert(self, audit):
+        audit.setdefault('_id', ObjectId())
+        values = self._get_values(audit)
+        values['id'] = str(audit['_id'])
+
+        query = 'INSERT INTO actions ({}) VALUES ({})'.format(
+            ', '.join(values), ', '.join('?' * len(values)))
+        self.connection.execute(query, list(values.values()))
+        return audit['_id']
+
+    def update(self, aid, audit):
+        values = self._get_values(audit)
+        query = 'UPDATE actions SET {} WHERE id = ?'.format(
+            ', '.join('{} = ?'.format(column) for column in values))
+        self.connection.execute(query, list(values.values()) + [str(aid)])
+
+    def close(self):
+        self.connection.close()
+
+
+class MongoAuditWriter(AuditWriter):
+    """Write the action audit documents straight into the auditdb actions collection.
+
+    If ``bucket`` is ``day`` or ``week``, the audit documents are written into
+    a different ``actions_<bucket>`` collection for each day or week, based on
+    the generation time of their _id. If ``ttl`` is also given, the buckets
+    older than ``ttl`` seconds are dropped whenever a new one is created.
+
+    If ``rollups`` is True, a rollup document with the counters of each action
+    of each session is also maintained, so Report does not need to aggregate
+    all the action audits of a session.
+    """
+
+    COLLECTION = 'actions'
+    ROLLUPS = 'action_rollups'
+    BUCKETS = {
+        'day': '%Y%m%d',
+        'week': '%G_w%V',
+    }
+
+    def __init__(self, auditdb, single=False, bucket=None, ttl=None, rollups=False):
+        if bucket is not None and bucket not in self.BUCKETS:
+            raise ValueError('Invalid audit bucket: {}'.format(bucket))
+
+        super().__init__(single)
+        self.auditdb = auditdb
+
+        self.bucket = bucket
+        self.ttl = ttl
+        self.buckets = set()
+
+        self.rollups = rollups
+        self.rolling = dict()    # (session, action) of the running actions, by audit id
+
+    def _get_name(self, when):
+        if not self.bucket:
+            return self.COLLECTION
+
+        return self.COLLECTION + '_' + when.strftime(self.BUCKETS[self.bucket])
+
+    def _create_bucket(self, name):
+        try:
+            self.auditdb[name].create_index(
+                [('session', ASCENDING), ('_id', DESCENDING)], background=True)
+
+            if self.ttl:
+                expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+                oldest = self._get_name(expired)
+                for collection in self.auditdb.list_collection_names():
+                    if collection.startswith(self.COLLECTION + '_') and collection < oldest:
+                        LOGGER.info('Dropping expired audit bucket %s', collection)
+                        self.auditdb.drop_collection(collection)
+
+        except PyMongoError:
+            LOGGER.exception('Could not set up the audit bucket %s', name)
+
+        self.buckets.add(name)
+
+    def _get_collection_name(self, aid):
+        if not self.bucket:
+            return self.COLLECTION
+
+        name = self._get_name(aid.generation_time)
+        if name not in self.buckets:
+            self._create_bucket(name)
+
+        return name
+
+    def get_collections(self, start, end=None):
+        """Collections which may hold the audits of the actions started between start and end."""
+        if not self.bucket:
+            return [self.auditdb[self.COLLECTION]]
+
+        start = start.replace(tzinfo=None)
+        end = (end or datetime.datetime.utcnow()).replace(tzinfo=None)
+        names = list()
+        while start.date() <= end.date():
+            name = self._get_name(start)
+            if name not in names:
+                names.append(name)
+
+            start += datetime.timedelta(days=1)
+
+        return [self.auditdb[name] for name in names]
+
+    def insert(self, audit):
+        """Insert a new audit document and return its _id."""
+        if self.bucket:
+            audit.setdefault('_id', ObjectId())
+
+        collection = self._get_collection_name(audit.get('_id'))
+        aid = self.auditdb[collection].insert(audit)
+        self._rollup(aid, audit)
+        return aid
+
+    def update(self, aid, audit):
+        """Set the given values into an existing audit document."""
+        collection = self._get_collection_name(aid)
+        self.auditdb[collection].update({'_id': aid}, {'$set': audit})
+        self._rollup(aid, audit)
+
+    def _rollup(self, aid, audit):
+        """Update the counters of the action rollup with the given audit write."""
+        if not self.rollups:
+            return
+
+        if 'action' in audit:
+            key = (audit['session'], audit['action'])
+            inc = {'called': 1}
+            if audit['status'] == 'RUNNING':
+                self.rolling[aid] = key
+
+        else:
+            key = self.rolling.pop(aid, None)
+            inc = dict()
+            if key is None:
+                return
+
+        elapsed = None
+        if audit.get('status') in ('OK', 'EXCEPTION'):
+            elapsed = audit.get('elapsed', 0)
+            inc[audit['status']] = 1
+            inc['total_ms'] = elapsed
+
+        if inc:
+            self._write_rollup(key, inc, elapsed)
+
+    @staticmethod
+    def _get_rollup_update(key, inc, max_ms):
+        match = {'session': key[0], 'action': key[1]}
+        update = {
+            '$inc': inc,
+            '$max': {'update_ts': datetime.datetime.utcnow()}    # Used to expire the rollups
+        }
+        if max_ms is not None:
+            update['$max']['max_ms'] = max_ms
+
+        return match, update
+
+    def _write_rollup(self, key, inc, max_ms):
+        match, update = self._get_rollup_update(key, inc, max_ms)
+        self.auditdb[self.ROLLUPS].update_one(match, update, upsert=True)
+
+    def get_rollups(self, session):
+        """Get the rollup documents of all the actions of a session."""
+        return list(self.auditdb[self.ROLLUPS].find({'session': session}))
+
+
+class BulkMongoAuditWriter(MongoAuditWriter):
+    """Buffer the action audit writes and send them to MongoDB using bulk_write.
+
+    The buffer is flushed in the background every ``flush_interval`` seconds
+    or as soon as it holds ``bulk_size`` writes, and also when the writer is
+    closed. If the buffer reaches ``max_size`` writes because MongoDB cannot
+    keep up, new writes block until it has been flushed. The rollup counters
+    of each action are added up in memory and written once per flush.
+
+    Audit document _ids are generated client side, so they can be returned
+    before the document is actually inserted. Flushes are serialized to make
+    sure that each update is written after its insert.
+    """
+
+    def __init__(self, auditdb, bulk_size=1000, flush_interval=1, max_size=None,
+                 single=False, bucket=None, ttl=None, rollups=False):
+        super().__init__(auditdb, single, bucket, ttl, rollups)
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size or bulk_size * 10
+
+        self.requests = list()
+        self.pending_rollups = dict()
+        self.lock = Semaphore()
+        self.flusher = gevent.spawn(self._flush_periodically)
+
+    def _flush_periodically(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            self.flush()
+
+    def _add(self, aid, request):
+        self.requests.append((self._get_collection_name(aid), request))
+        if len(self.requests) >= self.max_size:
+            self.flush()
+
+        elif len(self.requests) == self.bulk_size:
+            gevent.spawn(self.flush)
+
+    def insert(self, audit):
+        audit.setdefault('_id', ObjectId())
+        self._add(audit['_id'], InsertOne(audit))
+        self._rollup(audit['_id'], audit)
+        return audit['_id']
+
+    def update(self, aid, audit):
+        self._add(aid, UpdateOne({'_id': aid}, {'$set': audit}))
+        self._rollup(aid, audit)
+
+    def _write_rollup(self, key, inc, max_ms):
+        pending_inc, pending_max = self.pending_rollups.get(key, (dict(), None))
+        for field, value in inc.items():
+            pending_inc[field] = pending_inc.get(field, 0) + value
+
+        if max_ms is not None and (pending_max is None or max_ms > pending_max):
+            pending_max = max_ms
+
+        self.pending_rollups[key] = (pending_inc, pending_max)
+
+    def _flush_rollups(self):
+        rollups, self.pending_rollups = self.pending_rollups, dict()
+        requests = [
+            UpdateOne(*self._get_rollup_update(key, inc, max_ms), upsert=True)
+            for key, (inc, max_ms) in rollups.items()
+        ]
+        if requests:
+            try:
+                self.auditdb[self.ROLLUPS].bulk_write(requests, ordered=False)
+
+            except PyMongoError:
+                LOGGER.exception('Could not write %s audit rollups', len(requests))
+
+    def flush(self):
+        with self.lock:
+            requests, self.requests = self.requests, list()
+
+            collections = OrderedDict()
+            for collection, request in requests:
+                collections.setdefault(collection, list()).append(request)
+
+            for collection, requests in collections.items():
+                try:
+                    self.auditdb[collection].bulk_write(requests, ordered=True)
+
+                except PyMongoError:
+                    LOGGER.exception('Could not write %s audit requests', len(requests))
+
+            self._flush_rollups()
+
+    def close(self):
+        self.flusher.kill()
+        self.flush()
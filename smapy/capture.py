@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import zlib
+
+import gridfs
+from bson import BSON, Binary, json_util
+from bson.errors import InvalidDocument
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SessionCapture(object):
+    """Slim down the request and response values stored into the session documents.
+
+    Dict values are first reduced to the keys in their allowlist, if any.
+    Then, the values whose BSON size exceeds ``max_size`` bytes are replaced
+    by a document with their size and sha1, plus, depending on ``overflow``:
+        - truncate: a JSON preview of the first ``max_size`` characters.
+        - hash: nothing else.
+        - zlib: the zlib compressed BSON, if it fits within ``max_size``,
+          or otherwise a truncated preview.
+        - gridfs: the id of a GridFS file holding the BSON.
+    """
+
+    OVERFLOWS = ('truncate', 'hash', 'zlib', 'gridfs')
+    GRIDFS_COLLECTION = 'session_capture'
+
+    def __init__(self, max_size=None, overflow='truncate', allowlists=None, mongodb=None):
+        if overflow not in self.OVERFLOWS:
+            raise ValueError('Invalid session capture overflow: {}'.format(overflow))
+
+        self.max_size = max_size
+        self.overflow = overflow
+        self.allowlists = allowlists or dict()
+        self.mongodb = mongodb
+        self._gridfs = None
+
+    @classmethod
+    def from_conf(cls, conf, mongodb):
+        allowlists = {
+            field: conf['session_{}_fields'.format(field)]
+            for field in ('body', 'params', 'env', 'response')
+            if conf.get('session_{}_fields'.format(field)) is not None
+        }
+        return cls(
+            max_size=conf.get('session_max_size'),
+            overflow=conf.get('session_overflow', 'truncate'),
+            allowlists=allowlists,
+            mongodb=mongodb,
+        )
+
+    @property
+    def gridfs(self):
+        if self._gridfs is None:
+            self._gridfs = gridfs.GridFS(self.mongodb, self.GRIDFS_COLLECTION)
+
+        return self._gridfs
+
+    def _overflow(self, value, data):
+        captured = {
+            'size': len(data),
+            'sha1': hashlib.sha1(data).hexdigest(),
+        }
+        if self.overflow == 'hash':
+            return captured
+
+        elif self.overflow == 'gridfs':
+            captured['gridfs'] = self.gridfs.put(data)
+            return captured
+
+        elif self.overflow == 'zlib':
+            compressed = zlib.compress(data)
+            if len(compressed) <= self.max_size:
+                captured['zlib'] = Binary(compressed)
+                return captured
+
+        captured['preview'] = json_util.dumps(value)[:self.max_size]
+        return captured
+
+    def capture(self, field, value):
+        """Get the value to store into the session document for the given field."""
+        allowlist = self.allowlists.get(field)
+        if allowlist is not None and isinstance(value, dict):
+            value = {key: value[key] for key in allowlist if key in value}
+
+        if self.max_size is None:
+            return value
+
+        try:
+            data = BSON.encode({'value': value})
+
+        except (InvalidDocument, TypeError) as error:
+            LOGGER.warning('Could not measure the session %s: %s', field, error)
+            return value
+
+        if len(data) <= self.max_size:
+            return value
+
+        return self._overflow(value, data)
+
+    def load(self, captured):
+        """Get back a value stored using zlib or gridfs overflow."""
+        if isinstance(captured, dict) and 'zlib' in captured:
+            data = zlib.decompress(captured['zlib'])
+
+        elif isinstance(captured, dict) and 'gridfs' in captured:
+            data = self.gridfs.get(captured['gridfs']).read()
+
+        else:
+            return captured
+
+        return BSON(data).decode()['value']
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import gevent
+
+_process_pool = None
+_process_pool_pid = None
+
+
+def get_process_pool(max_workers=None):
+    """Get the process pool of this worker, creating it on first use.
+
+    The pool processes are started using ``spawn``, so they do not inherit
+    the gevent hub, the MongoDB clients or the sockets of the worker.
+    """
+    global _process_pool, _process_pool_pid
+
+    if _process_pool is None or _process_pool_pid != os.getpid():
+        context = multiprocessing.get_context('spawn')
+        _process_pool = ProcessPoolExecutor(max_workers, mp_context=context)
+        _process_pool_pid = os.getpid()
+
+    return _process_pool
+
+
+def _process(action_class, message):
+    """Run the process method of an action inside a pool process.
+
+    The action is not initialized, so only the message is available to it.
+    """
+    action = action_class.__new__(action_class)
+    action.logger = logging.getLogger(action_class.name)
+    action.process(message)
+    return message
+
+
+def run_in_process(action_class, message, max_workers=None):
+    """Run action_class.process on a copy of the message in the process pool.
+
+    The message is pickled to the pool process, and the processed copy is
+    returned. The wait happens in the gevent threadpool, so the other
+    greenlets of the worker keep running meanwhile.
+    """
+    future = get_process_pool(max_workers).submit(_process, action_class, message)
+    return gevent.get_hub().threadpool.spawn(future.result).get()
@@ -4,14 +4,31 @@ import datetime
 import json
 import os
 import socket
+import zlib
 
 import falcon
-from bson import ObjectId, json_util
+from bson import BSON, ObjectId, json_util
+from bson.errors import InvalidBSON
 
-from smapy.utils import get_ms
+from smapy.utils import ENCODINGS, compress, decompress, get_encoding, get_ms
+
+BSON_CONTENT_TYPE = 'application/bson'
+JSON_CONTENT_TYPE = 'application/json'
 
 
 class JSONSerializer(object):
+    """Serialize the request and response bodies.
+
+    Request bodies compressed with gzip or deflate are decompressed, and
+    responses bigger than compress_min_size bytes are compressed using
+    the encoding preferred by the client, if any. Compression is disabled
+    if compress_min_size is None. compress_level goes from 1, the fastest,
+    to 9, the smallest.
+    """
+
+    def __init__(self, compress_min_size=1024, compress_level=1):
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
 
     def process_request(self, req, resp):
         # req.stream corresponds to the WSGI wsgi.input environ variable,
@@ -28,6 +45,26 @@ class JSONSerializer(object):
             raise falcon.HTTPBadRequest('Empty request body',
                                         'A valid JSON document is required.')
 
+        encoding = req.get_header('Content-Encoding')
+        if encoding in ENCODINGS:
+            try:
+                body = decompress(body, encoding)
+
+            except (OSError, EOFError, zlib.error):
+                raise falcon.HTTPBadRequest('Malformed body',
+                                            'Body could not be decompressed.') from None
+
+        if req.content_type == BSON_CONTENT_TYPE:
+            # The request comes from another API instance which talks BSON
+            try:
+                req.body = BSON(body).decode()
+
+            except InvalidBSON:
+                raise falcon.HTTPBadRequest('Malformed BSON',
+                                            'A valid BSON document is required.') from None
+
+            return
+
         try:
             # Load the body using bson.json_util to allow being passed
             # unserializable objects such as ObjectIDs or datetimes
@@ -61,13 +98,35 @@ class JSONSerializer(object):
 
         elif req.context.get('internal'):
             # The request comes from another API instance, so we serialize
-            # the body using json_util to avoid losing information.
-            resp.body = json_util.dumps(resp.body, indent=4)
+            # the body using BSON, if accepted, or json_util to avoid losing information.
+            accepted = req.client_prefers((BSON_CONTENT_TYPE, JSON_CONTENT_TYPE))
+            if accepted == BSON_CONTENT_TYPE:
+                resp.body = BSON.encode(resp.body)
+                resp.content_type = BSON_CONTENT_TYPE
+
+            else:
+                resp.body = json_util.dumps(resp.body)
 
         else:
             # The request is external, so we "pretty print" the response.
             resp.body = json.dumps(resp.body, sort_keys=True, default=self._serial, indent=4)
 
+        self._compress(req, resp)
+
+    def _compress(self, req, resp):
+        if self.compress_min_size is None or len(resp.body) < self.compress_min_size:
+            return
+
+        encoding = get_encoding(req.get_header('Accept-Encoding') or '')
+        if encoding:
+            body = resp.body
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+
+            resp.body = compress(body, encoding, self.compress_level)
+            resp.set_header('Content-Encoding', encoding)
+            resp.append_header('Vary', 'Accept-Encoding')
+
 
 class ResponseBuilder(object):
 
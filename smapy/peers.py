@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class PeerUnavailable(Exception):
+    """Raised when all the peers have their circuit breaker open."""
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a peer which is failing or too slow.
+
+    The breaker keeps the outcome of the last ``window`` requests. Requests
+    which raise an error or last more than ``slow`` seconds count as failed.
+    Once there are at least ``min_requests`` outcomes and the rate of failed
+    ones reaches ``error_rate``, the breaker opens and no requests are sent
+    to the peer during ``cooldown`` seconds. After that, the breaker becomes
+    half open and lets a single probe request through: if it succeeds the
+    breaker closes again, and otherwise it opens for another cooldown.
+    The probe is claimed when the peer is chosen, and the claim expires
+    after a cooldown in case the probe request is never sent.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, error_rate=0.5, slow=None, min_requests=20, window=100, cooldown=5):
+        self.error_rate = error_rate
+        self.slow = slow
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probing = None    # When the probe was claimed
+
+    def allow(self):
+        """Tell whether a request can be sent now."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN:
+            return self.probing is None or time.monotonic() - self.probing >= self.cooldown
+
+        return self.state == self.CLOSED
+
+    def acquire(self):
+        """Claim the probe for the request about to be sent if the breaker is half open."""
+        if self.state == self.HALF_OPEN:
+            self.probing = time.monotonic()
+            return True
+
+        return False
+
+    def release(self):
+        self.probing = None
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+    def record(self, failed, latency=None, probe=False):
+        if self.slow is not None and latency is not None and latency > self.slow:
+            failed = True
+
+        if probe:
+            if failed:
+                self._open()
+
+            else:
+                self.state = self.CLOSED
+                self.outcomes.clear()
+
+            return
+
+        elif self.state != self.CLOSED:
+            # Late outcome of a request sent before the breaker opened
+            return
+
+        self.outcomes.append(failed)
+        if len(self.outcomes) >= self.min_requests:
+            if sum(self.outcomes) / len(self.outcomes) >= self.error_rate:
+                self._open()
+                self.outcomes.clear()
+
+
+class Peer(object):
+    """A remote API instance able to run runnables.
+
+    Each peer keeps track of its requests in flight and of the latencies
+    of its last successful requests, and optionally has a circuit breaker.
+    """
+
+    MIN_SAMPLES = 10
+
+    def __init__(self, endpoint, window=100, breaker=None):
+        self.endpoint = endpoint
+        self.in_flight = 0
+        self.latencies = deque(maxlen=window)
+        self.breaker = breaker
+        self.probe = False    # If True, the next tracked request is the breaker probe
+
+    def available(self):
+        return self.breaker is None or self.breaker.allow()
+
+    def success(self, latency, probe=False):
+        self.latencies.append(latency)
+        if self.breaker:
+            self.breaker.record(False, latency, probe)
+
+    def cancelled(self, elapsed):
+        """Keep the elapsed time of a cancelled request as its latency.
+
+        This is a lower bound of the actual latency, but dropping the
+        cancelled requests would leave only the fastest ones in the window.
+        """
+        self.latencies.append(elapsed)
+
+    def failure(self, probe=False):
+        if self.breaker:
+            self.breaker.record(True, probe=probe)
+
+    def percentile(self, percentile):
+        """Latency percentile in seconds, or None if there are not enough samples yet."""
+        if len(self.latencies) < self.MIN_SAMPLES:
+            return None
+
+        latencies = sorted(self.latencies)
+        index = int(round(percentile / 100 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def __repr__(self):
+        return 'Peer({})'.format(self.endpoint)
+
+
+class PeerSet(object):
+    """Route the remote requests among a list of peers.
+
+    Supported routings are:
+        - least_outstanding: choose the peer with less requests in flight,
+          breaking ties at random.
+        - power_of_two: pick two peers at random and choose the one with
+          less requests in flight.
+
+    If ``breaker`` is given, it must be a dict with the arguments used to
+    create a CircuitBreaker for each peer, and peers with an open breaker
+    are skipped.
+    """
+
+    ROUTINGS = ('least_outstanding', 'power_of_two')
+
+    def __init__(self, endpoints, routing='least_outstanding', breaker=None):
+        if not endpoints:
+            raise ValueError('At least one peer endpoint is required')
+
+        if routing not in self.ROUTINGS:
+            raise ValueError('Invalid routing: {}'.format(routing))
+
+        self.peers = [
+            Peer(endpoint, breaker=CircuitBreaker(**breaker) if breaker is not None else None)
+            for endpoint in endpoints
+        ]
+        self.routing = routing
+        self._choose = getattr(self, '_' + routing)
+
+    @staticmethod
+    def _least_outstanding(peers):
+        least = min(peer.in_flight for peer in peers)
+        return random.choice([peer for peer in peers if peer.in_flight == least])
+
+    @staticmethod
+    def _power_of_two(peers):
+        if len(peers) == 1:
+            return peers[0]
+
+        one, other = random.sample(peers, 2)
+        return one if one.in_flight <= other.in_flight else other
+
+    def choose(self, exclude=()):
+        """Choose an available peer, avoiding the excluded ones unless there is no other option.
+
+        Raises PeerUnavailable if no peer is available.
+        """
+        available = [peer for peer in self.peers if peer.available()]
+        if not available:
+            raise PeerUnavailable('No peer available')
+
+        peers = [peer for peer in available if peer not in exclude] or available
+        peer = self._choose(peers)
+
+        # Claim the probe right away, since the request may be sent from
+        # another greenlet, and others could choose this peer meanwhile
+        if peer.breaker and peer.breaker.acquire():
+            peer.probe = True
+
+        return peer
+
+    @staticmethod
+    @contextmanager
+    def track(peer):
+        """Count the request as in flight and record its outcome when it finishes.
+
+        Cancelled requests, which raise a BaseException, do not count as failed,
+        but their elapsed time is kept as their latency.
+        """
+        peer.in_flight += 1
+        probe, peer.probe = peer.probe, False
+
+        start = time.monotonic()
+        try:
+            yield peer
+
+        except Exception:
+            peer.failure(probe)
+            raise
+
+        except BaseException:
+            peer.cancelled(time.monotonic() - start)
+            raise
+
+        else:
+            peer.success(time.monotonic() - start, probe)
+
+        finally:
+            peer.in_flight -= 1
+            if probe:
+                peer.breaker.release()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import functools
 import os
 import socket
 import traceback
@@ -9,10 +10,11 @@ from abc import abstractmethod
 
 import falcon
 import gevent
+from bson import ObjectId
 from gevent.pool import Pool
 
 from smapy.runnable import Runnable
-from smapy.utils import get_bool, get_ms
+from smapy.utils import chunks, get_bool, get_ms
 
 
 class BaseResource(Runnable):
@@ -27,9 +29,15 @@ class BaseResource(Runnable):
     sync = None    # If True, make this resource always synchronous
     audit = True   # If False, skip session creation and audit tracking for this resource
 
+    # Default audit policies for the actions invoked by this resource. See BaseAction.
+    audit_sample_rate = None
+    audit_exceptions = None
+    audit_slow_ms = None
+
     @classmethod
     def init(cls, api, route):
         super(BaseResource, cls).init(api)
+        cls.session_capture = api.session_capture
         cls.route = route
         cls.endpoint = api.endpoint + route
 
@@ -53,19 +61,30 @@ class BaseResource(Runnable):
 
     @classmethod
     def start_session(cls, request, sync):
+        capture = cls.session_capture.capture
+        env = {k: v for k, v in request.env.items() if '.' not in k}
         session = {
             'status': 'RUNNING',
             'alive': True,
             'sync': sync,
             'resource': cls.name,
             'in_ts': request.context['in_ts'],
-            'body': request.body,
-            'params': request.params,
+            'body': capture('body', request.body),
+            'params': capture('params', request.params),
             'pid': os.getpid(),
             'host': socket.gethostname(),
-            'env': {k: v for k, v in request.env.items() if '.' not in k}
+            'env': capture('env', env),
+            '_id': ObjectId()
         }
-        request.context['session'] = cls.mongodb.session.insert(session)
+        if sync:
+            cls.mongodb.session.insert(session)
+
+        else:
+            # Do not make the caller wait for MongoDB: the session is
+            # inserted by the greenlet which runs the resource.
+            request.context['pending_session'] = session
+
+        request.context['session'] = session['_id']
         request.context['internal'] = False
         request.context['sync'] = sync
         cls.logger.info("Starting new session %s.", session['_id'])
@@ -87,18 +106,28 @@ class BaseResource(Runnable):
                 '$set': {
                     'out_ts': out_ts,
                     'elapsed': elapsed,
-                    'response': response,
+                    'response': self.session_capture.capture('response', response),
                     'status': status,
                     'alive': False,
                 }
             }
             self.mongodb.session.update_one(match, update)
 
+            self.forget_session(self.session)
+            if self.conf['api'].get('session_alive_broadcast'):
+                # Let the other workers know that this session is not alive anymore
+                self.mongodb[self.SESSION_EVENTS].insert_one({'session': self.session})
+
         self.logger.info("Ending session %s. Status: %s, Elapsed: %sms",
                          self.session, status, elapsed)
 
     def run_local(self, message):
-        response = self.process(message) or message
+        if self.blocking:
+            response = self.process_in_thread(message) or message
+
+        else:
+            response = self.process(message) or message
+
         if response and self.response_field:
             response = response.get(self.response_field)
 
@@ -107,6 +136,10 @@ class BaseResource(Runnable):
     def _run_public(self, body):
         status = 'OK'
         try:
+            pending_session = self.context.pop('pending_session', None)
+            if pending_session:
+                self.mongodb.session.insert(pending_session)
+
             response = self.run_local(body)
 
         except BaseException as ex:
@@ -132,6 +165,8 @@ class BaseResource(Runnable):
         sync = cls._is_sync(request)
         request.context['sync'] = sync
         request.context['audit'] = cls.audit
+        for policy in ('audit_sample_rate', 'audit_exceptions', 'audit_slow_ms'):
+            request.context[policy] = getattr(cls, policy)
 
         if cls.audit:
             sync = cls.start_session(request, sync)
@@ -170,11 +205,34 @@ class BaseResource(Runnable):
         else:
             return len(messages) > 1
 
+    def _get_batch_size(self, remote):
+        if not remote:
+            # Batches only make sense to spread the HTTP overhead
+            return 1
+
+        return int(self.conf['api'].get('remote_batch_size', 1))
+
+    def _run_batches(self, runnable, messages, batch_size, concurrency, callback=None):
+        """Run a single runnable remotely on many messages, sending them in batches."""
+        pool = Pool(concurrency)
+        greenlets = []
+
+        for batch in chunks(messages, batch_size):
+            runnable_ = self._get_runnable(runnable)
+            greenlet = pool.spawn(runnable_.run_batch, batch, callback)
+            greenlets.append(greenlet)
+
+        gevent.wait(greenlets)
+
     def _run_one(self, runnable, messages, concurrency, remote, callback=None):
         """Run a single runnable on a single or many messages."""
 
         if self._is_many(messages):
-            if concurrency == 1:
+            batch_size = self._get_batch_size(remote)
+            if batch_size > 1:
+                self._run_batches(runnable, messages, batch_size, concurrency, callback)
+
+            elif concurrency == 1:
                 # Skip gevent usage
                 for message in messages:
                     runnable_ = self._get_runnable(runnable)
@@ -239,3 +297,36 @@ class BaseResource(Runnable):
 
         else:
             self._run_one(runnable, message, concurrency, remote, callback)
+
+    def _run_message(self, runnable, remote, message):
+        self._get_runnable(runnable).run(message, remote)
+        return message
+
+    def _run_batch(self, runnable, batch):
+        self._get_runnable(runnable).run_batch(batch)
+        return batch
+
+    def invoke_iter(self, runnable, messages, concurrency=None, remote=False):
+        """Run a single runnable on many messages, yielding them as they are processed.
+
+        The messages are yielded in completion order, instead of waiting for
+        all of them to finish. When running remotely in batches, the messages
+        of each batch are yielded together once the batch finishes. If the
+        iteration is stopped early, the pending messages are cancelled.
+        """
+        concurrency = int(concurrency) if concurrency else self.conf['api'].get('concurrency', 10)
+        pool = Pool(concurrency)
+        batch_size = self._get_batch_size(remote)
+
+        try:
+            if batch_size > 1:
+                run_batch = functools.partial(self._run_batch, runnable)
+                for batch in pool.imap_unordered(run_batch, chunks(messages, batch_size)):
+                    yield from batch
+
+            else:
+                run_message = functools.partial(self._run_message, runnable, remote)
+                yield from pool.imap_unordered(run_message, messages)
+
+        finally:
+            pool.kill()
@@ -2,8 +2,12 @@
 
 import datetime
 import functools
+import hashlib
+from collections import OrderedDict
 
-from bson import ObjectId
+import falcon
+import gevent
+from bson import ObjectId, json_util
 
 from smapy import utils
 from smapy.resource import BaseResource
@@ -32,11 +36,143 @@ class HelloWorld(BaseResource):
 
 
 class Report(BaseResource):
-    """Get a report about a past or ongoing session."""
+    """Get a report about a past or ongoing session.
+
+    In single write audit mode, the running actions are not stored in the
+    auditdb, so the ones running in this worker are merged into the report.
+    If the audits are bucketed, all the buckets spanned by the session are read.
+    If the action rollups are enabled, they are read instead of aggregating
+    all the action audits of the session.
+
+    The reports of the sessions which finished more than report_cache_delay
+    seconds ago never change, so they are kept in an LRU cache of
+    report_cache_size entries and, if report_cache_persist is set, also stored
+    into the session document. They are served with an ETag, and requests
+    with a matching If-None-Match header get a 304 without running anything.
+    """
 
     sync = True
 
-    def get_action_details(self, match):
+    REPORT_FIELD = 'report_cache'
+    cache = OrderedDict()    # (session, details) => (report, etag)
+
+    # ##################
+    # finished reports #
+    # ##################
+
+    @staticmethod
+    def _get_cache_key(message):
+        session = message.get('session')
+        if session:
+            return str(session), utils.get_bool(message, 'details')
+
+    @classmethod
+    def get_cached(cls, key):
+        cached = cls.cache.get(key) if key else None
+        if cached:
+            cls.cache.move_to_end(key)
+
+        return cached
+
+    @classmethod
+    def set_cached(cls, key, report):
+        """Cache the report and return its etag."""
+        etag = hashlib.sha1(json_util.dumps(report, sort_keys=True).encode('utf-8')).hexdigest()
+
+        size = int(cls.conf['api'].get('report_cache_size', 1000))
+        if size:
+            cls.cache[key] = (report, etag)
+            while len(cls.cache) > size:
+                cls.cache.popitem(last=False)
+
+        return etag
+
+    def _is_finished(self, session):
+        out_ts = session.get('out_ts')
+        if not out_ts or session.get('alive'):
+            return False
+
+        delay = float(self.conf['api'].get('report_cache_delay', 10))
+        return (datetime.datetime.utcnow() - out_ts).total_seconds() >= delay
+
+    def _persist(self, session, details, report):
+        field = '{}.{}'.format(self.REPORT_FIELD, 'details' if details else 'summary')
+        self.mongodb.session.update_one({'_id': session['_id']}, {'$set': {field: report}})
+
+    @staticmethod
+    def _matches(request, etag):
+        if_none_match = request.get_header('If-None-Match')
+        if not if_none_match:
+            return False
+
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any(tag.replace('W/', '', 1).strip('"') == etag for tag in tags)
+
+    @classmethod
+    def on_get(cls, request, response):
+        cached = cls.get_cached(cls._get_cache_key(request.params))
+        if cached and cls._matches(request, cached[1]):
+            response.status = falcon.HTTP_304
+            response.etag = '"{}"'.format(cached[1])
+            return
+
+        super().on_get(request, response)
+
+        etag = request.context.get('etag')
+        if etag:
+            response.etag = '"{}"'.format(etag)
+
+    # ##############
+    # report build #
+    # ##############
+
+    def _aggregate(self, pipeline, collections=None):
+        if collections is None:
+            collections = [self.auditdb.actions]
+
+        for collection in collections:
+            yield from collection.aggregate(pipeline)
+
+    @staticmethod
+    def _merge_action_details(action, other):
+        for key in ('OK', 'EXCEPTION', 'called', 'total_ms'):
+            action[key] += other[key]
+
+        if other['max_ms'] is not None:
+            action['max_ms'] = max(action['max_ms'] or 0, other['max_ms'])
+
+        finished = action['OK'] + action['EXCEPTION']
+        action['avg_ms'] = action['total_ms'] / finished if finished else None
+
+    @staticmethod
+    def get_rollup_details(rollups):
+        actions = dict()
+        for rollup in rollups:
+            action = {
+                key: rollup.get(key, 0)
+                for key in ('OK', 'EXCEPTION', 'called', 'total_ms')
+            }
+            action['max_ms'] = rollup.get('max_ms')
+            finished = action['OK'] + action['EXCEPTION']
+            action['avg_ms'] = action['total_ms'] / finished if finished else None
+            actions[rollup['action'].replace('.', '_')] = action
+
+        return actions
+
+    @staticmethod
+    def get_rollup_summary(rollups):
+        summary = dict()
+        for rollup in rollups:
+            ok = rollup.get('OK', 0)
+            exception = rollup.get('EXCEPTION', 0)
+            for status, count in (('OK', ok), ('EXCEPTION', exception),
+                                  ('RUNNING', rollup.get('called', 0) - ok - exception)):
+                if count:
+                    summary[status] = summary.get(status, 0) + count
+
+        return summary
+
+    def get_action_details(self, match, running=(), collections=None, rollups=None):
         match = {
             '$match': match
         }
@@ -70,13 +206,34 @@ class Report(BaseResource):
 
         pipeline = [match, group]
 
-        actions = dict()
-        for action in self.auditdb.actions.aggregate(pipeline):
-            actions[action.pop('_id').replace('.', '_')] = action
+        if rollups is not None:
+            actions = self.get_rollup_details(rollups)
+
+        else:
+            actions = dict()
+            for action in self._aggregate(pipeline, collections):
+                name = action.pop('_id').replace('.', '_')
+                if name in actions:
+                    self._merge_action_details(actions[name], action)
+
+                else:
+                    actions[name] = action
+
+        for audit in running:
+            default = {
+                'OK': 0,
+                'EXCEPTION': 0,
+                'called': 0,
+                'avg_ms': None,
+                'max_ms': None,
+                'total_ms': 0
+            }
+            action = actions.setdefault(audit['action'].replace('.', '_'), default)
+            action['called'] += 1
 
         return actions
 
-    def get_action_summary(self, match):
+    def get_action_summary(self, match, running=(), collections=None, rollups=None):
         match = {
             '$match': match
         }
@@ -88,20 +245,23 @@ class Report(BaseResource):
                 }
             }
         }
-        summary = self.auditdb.actions.aggregate([match, group])
-        return {status['_id']: status['count'] for status in summary}
+        if rollups is not None:
+            summary = self.get_rollup_summary(rollups)
 
-    def get_session_counts(self, session):
-        match = {
-            'session': session['_id'],
-            'update_ts': {
-                '$gte': session['in_ts']
-            }
-        }
-        counts = {
-            collection: self.mongodb[collection].count(match)
-            for collection in ['links', 'post', 'occurrences']
-        }
+        else:
+            summary = dict()
+            for status in self._aggregate([match, group], collections):
+                summary[status['_id']] = summary.get(status['_id'], 0) + status['count']
+
+        if running:
+            summary['RUNNING'] = summary.get('RUNNING', 0) + len(running)
+
+        return summary
+
+    def _count(self, collection, match):
+        return self.mongodb[collection].count(match)
+
+    def _count_sites(self, match):
         match = {
             '$match': match
         }
@@ -121,11 +281,47 @@ class Report(BaseResource):
         pipeline = [match, group1, group2]
         results = list(self.mongodb.links.aggregate(pipeline))
         if results:
-            counts['sites'] = results[0]['count']
+            return results[0]['count']
+
+    def get_session_counts(self, session):
+        match = {
+            'session': session['_id'],
+            'update_ts': {
+                '$gte': session['in_ts']
+            }
+        }
+
+        # The queries are independent, so run them concurrently
+        greenlets = {
+            collection: gevent.spawn(self._count, collection, match)
+            for collection in ['links', 'post', 'occurrences']
+        }
+        greenlets['sites'] = gevent.spawn(self._count_sites, match)
+        gevent.joinall(greenlets.values(), raise_error=True)
+
+        counts = {key: greenlet.value for key, greenlet in greenlets.items()}
+        if counts['sites'] is None:
+            del counts['sites']
 
         return counts
 
+    @staticmethod
+    def get_last_activity(match, collections):
+        sort = [('_id', -1)]
+        for collection in reversed(collections):
+            last_action = collection.find_one(match, sort=sort)
+            if last_action:
+                return last_action.get('end_ts')
+
     def process(self, message):
+        details = utils.get_bool(message, 'details')
+        key = self._get_cache_key(message)
+        cached = self.get_cached(key)
+        if cached:
+            message.update(cached[0])
+            self.context['etag'] = cached[1]
+            return
+
         match = dict()
 
         session = message.get('session')
@@ -158,18 +354,42 @@ class Report(BaseResource):
             elapsed = out_ts - in_ts
             session['elapsed'] = str(elapsed)
 
-            match = {
-                'session': session['_id']
-            }
+            persisted = session.pop(self.REPORT_FIELD, dict())
+            report = persisted.get('details' if details else 'summary')
+            if report is None:
+                report = self.get_report(session, details)
+                if self._is_finished(session) and self.conf['api'].get('report_cache_persist'):
+                    self._persist(session, details, report)
 
-            # message['actions'] = self.auditdb.actions.count(match)
-            message['actions'] = self.get_action_summary(match)
-            last_action = self.auditdb.actions.find_one(match, sort=sort)
-            message['last_activity'] = last_action.get('end_ts') if last_action else None
+            message.update(report)
 
-            message['session_data'] = self.get_session_counts(session)
+        message['session'] = session
 
-            if utils.get_bool(message, 'details'):
-                message['details'] = self.get_action_details(match)
+        if key and session and self._is_finished(session):
+            self.context['etag'] = self.set_cached(key, dict(message))
 
-        message['session'] = session
+    def get_report(self, session, details):
+        match = {
+            'session': session['_id']
+        }
+
+        running = self.audit_writer.get_running(session['_id'])
+        collections = self.audit_writer.get_collections(session['in_ts'], session.get('out_ts'))
+        rollups = None
+        if self.audit_writer.rollups:
+            rollups = self.audit_writer.get_rollups(session['_id'])
+
+        # The queries are independent, so run them concurrently
+        greenlets = {
+            'actions': gevent.spawn(
+                self.get_action_summary, match, running, collections, rollups),
+            'last_activity': gevent.spawn(self.get_last_activity, match, collections),
+            'session_data': gevent.spawn(self.get_session_counts, session),
+        }
+        if details:
+            greenlets['details'] = gevent.spawn(
+                self.get_action_details, match, running, collections, rollups)
+
+        gevent.joinall(greenlets.values(), raise_error=True)
+
+        return {key: greenlet.value for key, greenlet in greenlets.items()}
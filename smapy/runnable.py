@@ -1,25 +1,55 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import time
 from abc import ABCMeta, abstractmethod
 
 import falcon
+import gevent
 import requests
-from bson import ObjectId, json_util
+from bson import BSON, ObjectId, json_util
+from bson.errors import InvalidBSON
+from gevent.pool import Pool
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+
+from smapy.middleware import BSON_CONTENT_TYPE
+from smapy.peers import PeerSet, PeerUnavailable
+from smapy.transport import UNIX_URL, UnixAdapter, get_url
+from smapy.utils import TrackedDict, apply_delta, compress
+
+NAMESPACE_EXISTS = 48    # MongoDB error code
 
 
 class RemoteRunnable(object):
 
     route = '/_remote'
+    UNAVAILABLE_STATUS_CODES = (502, 503, 504)
 
     @classmethod
     def init(cls, api):
         cls.api = api
         cls.mongodb = api.mongodb
-        cls.endpoint = api.endpoint + cls.route
         cls.name = cls.__name__
         cls.logger = logging.getLogger(cls.name)
 
+        endpoints = api.conf['api'].get('remote_endpoints') or [api.endpoint]
+        routing = api.conf['api'].get('remote_routing', 'least_outstanding')
+        breaker = cls._get_breaker_conf(api.conf['api'])
+        endpoints = [get_url(endpoint) + cls.route for endpoint in endpoints]
+        cls.peers = PeerSet(endpoints, routing, breaker)
+
+        cls.bson = api.conf['api'].get('remote_format') == 'bson'
+        cls.delta = bool(api.conf['api'].get('remote_delta', False))
+        cls.compress = bool(api.conf['api'].get('remote_compress', False))
+        cls.compress_min_size = api.conf['api'].get('compress_min_size', 1024)
+        cls.compress_level = api.conf['api'].get('compress_level', 1)
+
+        cls.timeout = api.conf['api'].get('remote_timeout')
+        cls.retries = int(api.conf['api'].get('remote_retries', 0))
+        cls.backoff = api.conf['api'].get('remote_backoff', 0.1)
+        cls.hedge_percentile = api.conf['api'].get('remote_hedge_percentile')
+
         cls.rq_session = requests.Session()
 
         pool_size = api.conf['api'].get('remote_pool_size', 1024)
@@ -28,6 +58,20 @@ class RemoteRunnable(object):
                                                 pool_block=True)
         cls.rq_session.mount('http://', adapter)
         cls.rq_session.mount('https://', adapter)
+        cls.rq_session.mount(UNIX_URL, UnixAdapter(pool_maxsize=pool_size, pool_block=True))
+
+    @staticmethod
+    def _get_breaker_conf(conf):
+        if not conf.get('remote_breaker'):
+            return None
+
+        return {
+            'error_rate': conf.get('remote_breaker_error_rate', 0.5),
+            'slow': conf.get('remote_breaker_slow'),
+            'min_requests': conf.get('remote_breaker_min_requests', 20),
+            'window': conf.get('remote_breaker_window', 100),
+            'cooldown': conf.get('remote_breaker_cooldown', 5),
+        }
 
     def __init__(self, runnable):
         self.runnable = runnable
@@ -35,23 +79,125 @@ class RemoteRunnable(object):
         logger = logging.getLogger(self.name)
         self.logger = logging.LoggerAdapter(logger, {'session': runnable.session})
 
-    def run(self, message):
-        self.logger.debug('Running remotly')
+    def _encode(self, body):
+        headers = {
+            'API-SESSION': str(self.runnable.session),
+            # requests accepts gzip by default, but compressing is not worth it between peers
+            'Accept-Encoding': 'gzip' if self.compress else 'identity',
+        }
+        if self.bson:
+            headers['Content-Type'] = BSON_CONTENT_TYPE
+            headers['Accept'] = BSON_CONTENT_TYPE
+            data = BSON.encode(body)
 
-        data = json_util.dumps({
-            'runnable': self.runnable.name,
-            'message': message,
-        })
-        headers = {'API-SESSION': str(self.runnable.session)}
+        else:
+            data = json_util.dumps(body)
+
+        if self.compress and len(data) >= self.compress_min_size:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+
+            data = compress(data, 'gzip', self.compress_level)
+            headers['Content-Encoding'] = 'gzip'
 
-        response = self.rq_session.post(self.endpoint, data=data, headers=headers)
+        return data, headers
+
+    def _decode(self, response):
+        if self.bson and response.headers.get('Content-Type') == BSON_CONTENT_TYPE:
+            return BSON(response.content).decode()
 
         self.logger.debug(response.text)
+        return json_util.loads(response.text)
+
+    def _request(self, peer, data, headers):
+        with self.peers.track(peer):
+            response = self.rq_session.post(peer.endpoint, data=data, headers=headers)
+            if response.status_code in self.UNAVAILABLE_STATUS_CODES:
+                # The peer is overloaded or down, so we count it as failed
+                raise requests.HTTPError(
+                    'Peer unavailable: {}'.format(response.status_code), response=response)
+
+            return response
+
+    def _hedged_request(self, peer, data, headers):
+        """Send the request and hedge it to another peer if it is slower than usual.
+
+        The first successful response is returned and the other request is cancelled.
+        """
+        delay = peer.percentile(self.hedge_percentile)
+        pending = [gevent.spawn(self._request, peer, data, headers)]
+        if delay is not None and not gevent.wait(pending, timeout=delay):
+            try:
+                hedge_peer = self.peers.choose(exclude=[peer])
+
+            except PeerUnavailable:
+                hedge_peer = peer
+
+            if hedge_peer is peer:
+                self.logger.debug('No other peer available to hedge the request')
+
+            else:
+                self.logger.debug('Hedging request to %s after %ss', hedge_peer, delay)
+                pending.append(gevent.spawn(self._request, hedge_peer, data, headers))
 
         try:
-            response_json = json_util.loads(response.text)
+            while True:
+                done = gevent.wait(pending, count=1)[0]
+                pending.remove(done)
+                if done.successful() or not pending:
+                    return done.get()
 
-        except ValueError:
+        finally:
+            gevent.killall(pending)
+
+    def _send(self, data, headers):
+        """Send the request, retrying and hedging it only if the runnable is idempotent."""
+        idempotent = self.runnable.idempotent
+        attempts = self.retries + 1 if idempotent else 1
+        failed = []
+
+        for attempt in range(attempts):
+            try:
+                peer = self.peers.choose(exclude=failed)
+
+            except PeerUnavailable:
+                self.logger.error('All the remote peers are unavailable')
+                raise falcon.HTTPServiceUnavailable(
+                    self.name, 'No remote peer available') from None
+
+            try:
+                if idempotent and self.hedge_percentile:
+                    return self._hedged_request(peer, data, headers)
+
+                return self._request(peer, data, headers)
+
+            except requests.RequestException as ex:
+                self.logger.warning('Remote request to %s failed: %s', peer, ex)
+                if attempt + 1 == attempts:
+                    raise falcon.HTTPInternalServerError(
+                        self.name, 'Remote request failed: {}'.format(ex)) from None
+
+                failed.append(peer)
+                gevent.sleep(self.backoff * 2 ** attempt)
+
+    def _post(self, body):
+        data, headers = self._encode(body)
+
+        with gevent.Timeout(self.timeout) as timeout:
+            try:
+                response = self._send(data, headers)
+
+            except gevent.Timeout as ex:
+                if ex is not timeout:
+                    raise
+
+                self.logger.error('Remote deadline of %ss exceeded', self.timeout)
+                raise falcon.HTTPGatewayTimeout(self.name, 'Remote deadline exceeded') from None
+
+        try:
+            response_json = self._decode(response)
+
+        except (ValueError, InvalidBSON):
             self.logger.error('Invalid response format: %s', response.text)
             raise falcon.HTTPInternalServerError(
                 self.name, 'Invalid remote response format') from None
@@ -60,16 +206,61 @@ class RemoteRunnable(object):
         self.logger.debug('Remote status: %s', status)
 
         if status != falcon.HTTP_200:
-            self.logger.error('Remote status not OK: %s', response.text)
+            self.logger.error('Remote status not OK: %s', response_json)
             raise falcon.HTTPInternalServerError(self.name, 'Error status: {}'.format(status))
 
-        message.update(response_json['results']['message'])
+        return response_json['results']
+
+    def _update(self, message, result):
+        if self.delta:
+            apply_delta(message, result)
+
+        else:
+            message.update(result)
+
+    def run(self, message):
+        self.logger.debug('Running remotly')
+
+        body = {
+            'runnable': self.runnable.name,
+            'message': message,
+        }
+        if self.delta:
+            body['delta'] = True
+
+        results = self._post(body)
+        self._update(message, results['delta' if self.delta else 'message'])
+
+    def run_batch(self, messages):
+        """Run the runnable remotely on many messages using a single request."""
+        self.logger.debug('Running %s messages remotly', len(messages))
+
+        body = {
+            'runnable': self.runnable.name,
+            'messages': messages,
+        }
+        if self.delta:
+            body['delta'] = True
+
+        results = self._post(body)
+
+        results = results['deltas' if self.delta else 'messages']
+        if len(results) != len(messages):
+            self.logger.error('Expected %s messages, got %s', len(messages), len(results))
+            raise falcon.HTTPInternalServerError(self.name, 'Invalid remote batch size')
+
+        for message, result in zip(messages, results):
+            self._update(message, result)
 
     @classmethod
     def on_post(cls, req, resp):
-        """Run the indicated runnable passing the given message."""
+        """Run the indicated runnable passing the given message or messages.
+
+        If delta is requested, only the changes done to each message are returned.
+        """
+        batch = 'messages' in req.body
         try:
-            message = req.body['message']
+            messages = req.body['messages'] if batch else [req.body['message']]
             runnable = req.body['runnable']
 
         except KeyError as ke:
@@ -82,15 +273,33 @@ class RemoteRunnable(object):
         req.context['session'] = ObjectId(session)
         req.context['internal'] = True
 
-        cls.logger.debug('Running runnable %s', runnable, extra={'session': session})
+        cls.logger.debug('Running runnable %s on %s messages', runnable, len(messages),
+                         extra={'session': session})
 
         runnable_class = cls.api.runnables[runnable]
-        runnable_class(req).run_local(message)
+        delta = req.body.get('delta', False)
+
+        def run_local(message):
+            if not delta:
+                runnable_class(req).run_local(message)
+                return message
+
+            # Only the values read by the runnable are copied to get the delta
+            tracked = TrackedDict(message)
+            runnable_class(req).run_local(tracked)
+            return tracked.get_delta()
 
         resp.body = {
             'runnable': runnable,
-            'message': message,
         }
+        if batch:
+            concurrency = cls.api.conf['api'].get('concurrency', 10)
+            results = Pool(concurrency).map(run_local, messages)
+            resp.body['deltas' if delta else 'messages'] = results
+
+        else:
+            resp.body['delta' if delta else 'message'] = run_local(messages[0])
+
         cls.logger.debug('runnable %s status: OK', runnable, extra={'session': session})
 
 
@@ -114,6 +323,13 @@ class RunnableMeta(ABCMeta):
 
 class Runnable(metaclass=RunnableMeta):
 
+    idempotent = False    # If True, remote calls can be retried and hedged
+    blocking = False    # If True, run process in the gevent threadpool
+
+    SESSION_EVENTS = 'session_events'
+    MAX_ALIVE_SESSIONS = 10000
+    _alive_sessions = dict()    # Sessions known to be alive in this worker, with their expiration
+
     def __init__(self, request):
         self.request = request
         self.context = request.context
@@ -125,6 +341,7 @@ class Runnable(metaclass=RunnableMeta):
         cls.api = api
         cls.mongodb = api.mongodb
         cls.auditdb = api.auditdb
+        cls.audit_writer = api.audit_writer
         cls.conf = api.conf
         cls.logger = logging.getLogger(cls.name)
 
@@ -132,7 +349,84 @@ class Runnable(metaclass=RunnableMeta):
     def run_local(self, message):
         """The actual runnable code should be implemented here by subclasses."""
 
+    def process_in_thread(self, message):
+        """Run process in the gevent threadpool and return its response.
+
+        This keeps the worker responsive while blocking calls which gevent
+        cannot patch, such as C extensions, run. The process method of
+        blocking runnables must not rely on gevent, invoke included.
+        """
+        return gevent.get_hub().threadpool.apply(self.process, (message,))
+
+    @classmethod
+    def _cache_session_alive(cls, session, ttl):
+        alive_sessions = Runnable._alive_sessions
+        if len(alive_sessions) >= cls.MAX_ALIVE_SESSIONS:
+            now = time.monotonic()
+            for expired in [key for key, expiration in alive_sessions.items() if expiration < now]:
+                del alive_sessions[expired]
+
+            if len(alive_sessions) >= cls.MAX_ALIVE_SESSIONS:
+                alive_sessions.clear()
+
+        alive_sessions[session] = time.monotonic() + ttl
+
+    @staticmethod
+    def forget_session(session):
+        """Remove the session from the alive sessions cache of this worker."""
+        Runnable._alive_sessions.pop(session, None)
+
+    @classmethod
+    def _create_session_events(cls, mongodb):
+        try:
+            mongodb.create_collection(cls.SESSION_EVENTS, capped=True, size=1024 * 1024)
+
+        except CollectionInvalid:
+            pass    # Already exists
+
+        except OperationFailure as error:
+            if error.code != NAMESPACE_EXISTS:
+                raise
+
+            # Created meanwhile by another worker
+
+    @classmethod
+    def watch_sessions(cls, mongodb):
+        """Forget the sessions ended by other workers.
+
+        The ended sessions are read by tailing the capped SESSION_EVENTS collection.
+        This is meant to be run forever in its own greenlet.
+        """
+        created = False
+        last_id = ObjectId()
+        while True:
+            try:
+                if not created:
+                    cls._create_session_events(mongodb)
+                    created = True
+
+                match = {'_id': {'$gt': last_id}}
+                cursor = mongodb[cls.SESSION_EVENTS].find(
+                    match, cursor_type=CursorType.TAILABLE_AWAIT)
+                for event in cursor:
+                    last_id = event['_id']
+                    cls.forget_session(event['session'])
+
+            except PyMongoError:
+                logging.getLogger(__name__).exception('Error watching the session events')
+
+            gevent.sleep(1)
+
     def check_session_alive(self):
+        """Make sure that the session is still alive before running.
+
+        If session_alive_ttl is set in conf['api'], sessions found alive are
+        cached during that many seconds to skip querying the database again.
+        """
+        ttl = float(self.conf['api'].get('session_alive_ttl', 0))
+        if ttl and Runnable._alive_sessions.get(self.session, 0) > time.monotonic():
+            return
+
         match = {
             '_id': self.session
         }
@@ -145,6 +439,9 @@ class Runnable(metaclass=RunnableMeta):
             raise falcon.HTTPInternalServerError(
                 self.name, 'Session {} not alive'.format(self.session))
 
+        if ttl:
+            self._cache_session_alive(self.session, ttl)
+
     def run(self, message, remote=False, callback=None):
         self.check_session_alive()
 
@@ -156,3 +453,13 @@ class Runnable(metaclass=RunnableMeta):
 
         if callback:
             callback(message)
+
+    def run_batch(self, messages, callback=None):
+        """Run this runnable remotely on a batch of messages using a single request."""
+        self.check_session_alive()
+
+        RemoteRunnable(self).run_batch(messages)
+
+        if callback:
+            for message in messages:
+                callback(message)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import socket
+from urllib.parse import quote, unquote, urlparse
+
+import requests
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+UNIX_ENDPOINT = 'unix://'
+UNIX_URL = 'http+unix://'
+
+
+def get_url(endpoint):
+    """Convert an endpoint into a URL that requests can use.
+
+    Unix domain socket endpoints, in the form ``unix:///path/to.sock``,
+    are converted to ``http+unix://`` URLs with the quoted socket path as host.
+
+    >>> get_url('http://127.0.0.1:8001')
+    'http://127.0.0.1:8001'
+    >>> get_url('unix:///tmp/smapy.sock')
+    'http+unix://%2Ftmp%2Fsmapy.sock'
+    """
+    if endpoint.startswith(UNIX_ENDPOINT):
+        return UNIX_URL + quote(endpoint[len(UNIX_ENDPOINT):], safe='')
+
+    return endpoint
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTPConnection which connects to a Unix domain socket instead of a TCP port."""
+
+    def __init__(self, socket_path, timeout=None, **kwargs):
+        super().__init__('localhost', **kwargs)
+        self.socket_path = socket_path
+        self.unix_timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.unix_timeout, (int, float)):
+            sock.settimeout(self.unix_timeout)
+
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__('localhost', **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixHTTPConnection(self.socket_path, timeout=self.timeout.connect_timeout)
+
+
+class UnixAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter to send ``http+unix://`` requests through Unix domain sockets."""
+
+    def __init__(self, pool_maxsize=requests.adapters.DEFAULT_POOLSIZE, pool_block=False):
+        self.unix_pools = dict()
+        self.unix_pool_maxsize = pool_maxsize
+        self.unix_pool_block = pool_block
+        super().__init__()
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unquote(urlparse(url).netloc)
+        pool = self.unix_pools.get(socket_path)
+        if pool is None:
+            pool = UnixHTTPConnectionPool(socket_path, maxsize=self.unix_pool_maxsize,
+                                          block=self.unix_pool_block)
+            self.unix_pools[socket_path] = pool
+
+        return pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        for pool in self.unix_pools.values():
+            pool.close()
+
+        self.unix_pools.clear()
+        super().close()
@@ -2,11 +2,17 @@
 
 import configparser
 import copy
+import gzip
 import importlib
+import itertools
+import logging
 import os
 import pkgutil
+import zlib
 from collections import defaultdict
 
+LOGGER = logging.getLogger(__name__)
+
 
 def find_subclasses(parent_class, recursive=False):
     """Find the subclasses of a given parent class."""
@@ -111,6 +117,148 @@ def safecopy(obj):
     return copy.deepcopy(obj)
 
 
+class TrackedDict(dict):
+    """Dict which copies the original value of each key the first time it is accessed.
+
+    This allows rebuilding the original contents of the dict, as ``safecopy``
+    would have returned them, while deep copying only the values which may
+    have been modified in place through it. Values which are replaced or
+    deleted do not need to be copied. Values which cannot be copied are
+    left out of the original contents, and always counted as changed.
+
+    >>> tracked = TrackedDict({'a': [1], 'b': [2], 'c': 3})
+    >>> tracked['a'].append(4)
+    >>> tracked['c'] = 5
+    >>> del tracked['b']
+    >>> sorted(tracked.original().items())
+    [('a', [1]), ('b', [2]), ('c', 3)]
+    >>> sorted(tracked.copies)
+    ['a']
+    """
+
+    def __init__(self, original):
+        super().__init__(original)
+        self._original = dict(original)
+        self.copies = dict()
+        self.uncopyable = set()
+
+    def _track(self, key):
+        missing = object()
+        value = self._original.get(key, missing)
+        if value is not missing and key not in self.copies and key not in self.uncopyable:
+            if dict.get(self, key, missing) is value:
+                try:
+                    self.copies[key] = safecopy(value)
+
+                except RuntimeError as rerror:
+                    LOGGER.error('Could not copy the initial value of %s: %s', key, rerror)
+                    self.uncopyable.add(key)
+
+    def _track_all(self):
+        for key in self._original:
+            self._track(key)
+
+    def original(self):
+        """Rebuild a deep copy of the dict contents as they were when it was created."""
+        return {
+            key: self.copies[key] if key in self.copies else safecopy(value)
+            for key, value in self._original.items()
+            if key not in self.uncopyable
+        }
+
+    def get_delta(self):
+        """Get the changes done through the dict, in the format of ``get_delta``.
+
+        Only the values which were accessed or replaced are compared, since
+        the others cannot have been modified.
+        """
+        missing = object()
+        original = dict()
+        modified = dict()
+        for key, value in dict.items(self):
+            initial = self.copies.get(key, self._original.get(key, missing))
+            if initial is not value or key in self.uncopyable:
+                modified[key] = value
+                if initial is not missing and key not in self.uncopyable:
+                    original[key] = initial
+
+        for key, value in self._original.items():
+            if not dict.__contains__(self, key):
+                original[key] = value
+
+        return get_delta(original, modified)
+
+    def __getitem__(self, key):
+        self._track(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._track(key)
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self._track(key)
+        return super().setdefault(key, default)
+
+    def pop(self, key, *args):
+        self._track(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        self._track_all()
+        return super().popitem()
+
+    def items(self):
+        self._track_all()
+        return super().items()
+
+    def values(self):
+        self._track_all()
+        return super().values()
+
+    def copy(self):
+        self._track_all()
+        return super().copy()
+
+    def __iter__(self):
+        # Overriding __iter__ prevents dict(tracked) and {**tracked}
+        # from reading the values without going through __getitem__
+        return super().__iter__()
+
+
+def get_delta(original, modified):
+    """Get the top level keys that were added, changed or deleted in a dict.
+
+    >>> get_delta({'a': 1, 'b': 2, 'c': 3}, {'a': 1, 'b': 4, 'd': 5})
+    {'set': {'b': 4, 'd': 5}, 'unset': ['c']}
+    >>> get_delta({'a': [1]}, {'a': [1]})
+    {'set': {}, 'unset': []}
+    """
+    missing = object()
+    return {
+        'set': {
+            key: value
+            for key, value in modified.items()
+            if original.get(key, missing) != value
+        },
+        'unset': [key for key in original if key not in modified]
+    }
+
+
+def apply_delta(message, delta):
+    """Apply to a dict the changes obtained with get_delta.
+
+    >>> message = {'a': 1, 'b': 2, 'c': 3}
+    >>> apply_delta(message, {'set': {'b': 4, 'd': 5}, 'unset': ['c']})
+    >>> message
+    {'a': 1, 'b': 4, 'd': 5}
+    """
+    for key in delta['unset']:
+        message.pop(key, None)
+
+    message.update(delta['set'])
+
+
 def get_ms(delta):
     """Convert a datetime.timedelta into the corresponding milliseconds.
 
@@ -127,6 +275,90 @@ def get_ms(delta):
     return delta.days * 24 * 60 * 60 * 1000 + delta.seconds * 1000 + delta.microseconds / 1000
 
 
+def chunks(iterable, size):
+    """Split an iterable into lists of at most ``size`` elements.
+
+    >>> list(chunks([1, 2, 3, 4, 5], 2))
+    [[1, 2], [3, 4], [5]]
+    >>> list(chunks((i for i in range(3)), 5))
+    [[0, 1, 2]]
+    >>> list(chunks([], 2))
+    []
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+ENCODINGS = ('gzip', 'deflate')
+
+
+def compress(data, encoding, level=1):
+    """Compress bytes using the given HTTP content encoding.
+
+    The level defaults to 1, since the higher ones cost much more CPU,
+    which blocks the worker, for a small gain in size.
+
+    >>> decompress(compress(b'some data', 'gzip'), 'gzip')
+    b'some data'
+    >>> decompress(compress(b'some data', 'deflate'), 'deflate')
+    b'some data'
+    """
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+
+    elif encoding == 'deflate':
+        return zlib.compress(data, level)
+
+    raise ValueError('Unsupported encoding: {}'.format(encoding))
+
+
+def decompress(data, encoding):
+    """Decompress bytes compressed with the given HTTP content encoding."""
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+
+    elif encoding == 'deflate':
+        return zlib.decompress(data)
+
+    raise ValueError('Unsupported encoding: {}'.format(encoding))
+
+
+def get_encoding(accept_encoding):
+    """Choose the preferred supported encoding from an Accept-Encoding header.
+
+    >>> get_encoding('gzip, deflate')
+    'gzip'
+    >>> get_encoding('deflate, gzip;q=0')
+    'deflate'
+    >>> get_encoding('*')
+    'gzip'
+    >>> get_encoding('br') is None
+    True
+    """
+    accepted = dict()
+    for item in accept_encoding.split(','):
+        encoding, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+
+            except ValueError:
+                quality = 0
+
+        accepted[encoding.strip().lower()] = quality
+
+    default = accepted.get('*', 0)
+    preferred = sorted(ENCODINGS, key=lambda encoding: -accepted.get(encoding, default))
+    for encoding in preferred:
+        if accepted.get(encoding, default) > 0:
+            return encoding
+
+
 def find_submodules(package):
     if isinstance(package, str):
         package = importlib.import_module(package)
@@ -1,7 +1,12 @@
 import copy
-from unittest.mock import call
+import datetime
+import time
+from unittest.mock import MagicMock, Mock, call, patch
 
-from smapy.resources.misc import MultiProcess
+import falcon
+import gevent
+
+from smapy.resources.misc import MultiProcess, Report
 from tests.utils import ResourceTestCase
 
 
@@ -72,3 +77,367 @@ class TestMultiProcess(ResourceTestCase):
                  concurrency=2, remote=True),
         ]
         self.assertEqual(expected_invoke_calls, self.invoke_call_args_list)
+
+
+class TestReport(ResourceTestCase):
+
+    resource_class = Report
+
+    def setUp(self):
+        super().setUp()
+        Report.cache.clear()
+        Report.conf = {'api': {}}
+
+    def test_get_action_summary_running(self):
+        """The running actions of this worker are added to the summary."""
+
+        # Set up
+        self.resource.auditdb.actions.aggregate.return_value = [
+            {'_id': 'OK', 'count': 3},
+            {'_id': 'RUNNING', 'count': 1}
+        ]
+        running = [{'action': 'an.action'}, {'action': 'an.action'}]
+
+        # Actual call
+        summary = self.resource.get_action_summary({'session': self.session}, running)
+
+        # Asserts
+        self.assertEqual({'OK': 3, 'RUNNING': 3}, summary)
+
+    def test_get_action_details_running(self):
+        """The running actions of this worker count as called."""
+
+        # Set up
+        self.resource.auditdb.actions.aggregate.return_value = [{
+            '_id': 'an.action',
+            'OK': 1,
+            'EXCEPTION': 0,
+            'called': 1,
+            'avg_ms': 10,
+            'max_ms': 10,
+            'total_ms': 10
+        }]
+        running = [{'action': 'an.action'}, {'action': 'another.action'}]
+
+        # Actual call
+        details = self.resource.get_action_details({'session': self.session}, running)
+
+        # Asserts
+        expected = {
+            'an_action': {
+                'OK': 1,
+                'EXCEPTION': 0,
+                'called': 2,
+                'avg_ms': 10,
+                'max_ms': 10,
+                'total_ms': 10
+            },
+            'another_action': {
+                'OK': 0,
+                'EXCEPTION': 0,
+                'called': 1,
+                'avg_ms': None,
+                'max_ms': None,
+                'total_ms': 0
+            }
+        }
+        self.assertEqual(expected, details)
+
+    def test_get_action_details_buckets(self):
+        """The details of the same action in different buckets are merged."""
+
+        # Set up
+        bucket = MagicMock()
+        bucket.aggregate.return_value = [{
+            '_id': 'an.action',
+            'OK': 1,
+            'EXCEPTION': 0,
+            'called': 1,
+            'avg_ms': 10,
+            'max_ms': 10,
+            'total_ms': 10
+        }]
+        other_bucket = MagicMock()
+        other_bucket.aggregate.return_value = [{
+            '_id': 'an.action',
+            'OK': 0,
+            'EXCEPTION': 1,
+            'called': 2,
+            'avg_ms': 30,
+            'max_ms': 30,
+            'total_ms': 30
+        }]
+
+        # Actual call
+        details = self.resource.get_action_details(
+            {'session': self.session}, collections=[bucket, other_bucket])
+
+        # Asserts
+        expected = {
+            'an_action': {
+                'OK': 1,
+                'EXCEPTION': 1,
+                'called': 3,
+                'avg_ms': 20,
+                'max_ms': 30,
+                'total_ms': 40
+            }
+        }
+        self.assertEqual(expected, details)
+
+    def test_get_action_summary_buckets(self):
+        """The summaries of all the buckets are added up."""
+
+        # Set up
+        bucket = MagicMock()
+        bucket.aggregate.return_value = [{'_id': 'OK', 'count': 3}]
+        other_bucket = MagicMock()
+        other_bucket.aggregate.return_value = [
+            {'_id': 'OK', 'count': 2},
+            {'_id': 'EXCEPTION', 'count': 1}
+        ]
+
+        # Actual call
+        summary = self.resource.get_action_summary(
+            {'session': self.session}, collections=[bucket, other_bucket])
+
+        # Asserts
+        self.assertEqual({'OK': 5, 'EXCEPTION': 1}, summary)
+
+    def test_get_action_summary_no_collections(self):
+        """If the audits are not stored in MongoDB, only the running actions are reported."""
+
+        # Set up
+        running = [{'action': 'an.action'}]
+
+        # Actual call
+        summary = self.resource.get_action_summary({'session': self.session}, running, [])
+
+        # Asserts
+        self.assertEqual({'RUNNING': 1}, summary)
+        self.resource.auditdb.actions.aggregate.assert_not_called()
+
+    def test_get_action_summary_rollups(self):
+        """If the rollups are given, no aggregation is run."""
+
+        # Set up
+        rollups = [
+            {'action': 'an.action', 'called': 4, 'OK': 2, 'EXCEPTION': 1},
+            {'action': 'another.action', 'called': 1, 'OK': 1},
+        ]
+
+        # Actual call
+        summary = self.resource.get_action_summary({'session': self.session}, rollups=rollups)
+
+        # Asserts
+        self.assertEqual({'OK': 3, 'EXCEPTION': 1, 'RUNNING': 1}, summary)
+        self.resource.auditdb.actions.aggregate.assert_not_called()
+
+    def test_get_action_details_rollups(self):
+        """If the rollups are given, no aggregation is run."""
+
+        # Set up
+        rollups = [
+            {'action': 'an.action', 'called': 4, 'OK': 2, 'EXCEPTION': 1,
+             'total_ms': 60, 'max_ms': 30},
+        ]
+
+        # Actual call
+        details = self.resource.get_action_details({'session': self.session}, rollups=rollups)
+
+        # Asserts
+        expected = {
+            'an_action': {
+                'OK': 2,
+                'EXCEPTION': 1,
+                'called': 4,
+                'avg_ms': 20,
+                'max_ms': 30,
+                'total_ms': 60
+            }
+        }
+        self.assertEqual(expected, details)
+        self.resource.auditdb.actions.aggregate.assert_not_called()
+
+    def _get_session(self, **kwargs):
+        session = {
+            '_id': self.session,
+            'in_ts': datetime.datetime(2018, 3, 4, 12),
+            'out_ts': datetime.datetime(2018, 3, 4, 13),
+            'alive': False
+        }
+        session.update(kwargs)
+        return session
+
+    def test_process_finished_cached(self):
+        """The report of a finished session is cached and served with an ETag."""
+
+        # Set up
+        session = self._get_session()
+        self.resource.mongodb.session.find_one.return_value = session
+        self.resource.get_report = Mock(return_value={'actions': {'OK': 1}})
+
+        # Actual call
+        message = {'session': str(self.session)}
+        self.resource.process(message)
+
+        cached_message = {'session': str(self.session)}
+        self.resource.process(cached_message)
+
+        # Asserts
+        self.resource.get_report.assert_called_once_with(session, False)
+        self.resource.mongodb.session.find_one.assert_called_once_with(
+            {'_id': self.session}, sort=[('_id', -1)])
+        self.assertEqual(message, cached_message)
+        self.assertEqual({'OK': 1}, cached_message['actions'])
+
+        etag = self.request.context['etag']
+        self.assertEqual([(str(self.session), False)], list(Report.cache))
+        self.assertEqual(etag, Report.cache[(str(self.session), False)][1])
+
+    def test_process_running_not_cached(self):
+        """The report of an alive session is not cached."""
+
+        # Set up
+        session = self._get_session(alive=True)
+        del session['out_ts']
+        self.resource.mongodb.session.find_one.return_value = session
+        self.resource.get_report = Mock(return_value={'actions': {'RUNNING': 1}})
+
+        # Actual call
+        self.resource.process({'session': str(self.session)})
+
+        # Asserts
+        self.assertEqual({}, Report.cache)
+        self.assertNotIn('etag', self.request.context)
+
+    def test_process_recently_finished_not_cached(self):
+        """Audits could still be buffered, so recently finished sessions are not cached."""
+
+        # Set up
+        session = self._get_session(out_ts=datetime.datetime.utcnow())
+        self.resource.mongodb.session.find_one.return_value = session
+        self.resource.get_report = Mock(return_value={'actions': {'OK': 1}})
+
+        # Actual call
+        self.resource.process({'session': str(self.session)})
+
+        # Asserts
+        self.assertEqual({}, Report.cache)
+
+    def test_process_persisted(self):
+        """A report persisted into the session document is reused and persisted only once."""
+
+        # Set up
+        Report.conf = {'api': {'report_cache_persist': True}}
+        session = self._get_session(report_cache={'details': {'actions': {'OK': 2}}})
+        self.resource.mongodb.session.find_one.return_value = session
+        self.resource.get_report = Mock(return_value={'actions': {'OK': 1}})
+
+        # Actual call
+        message = {'session': str(self.session), 'details': 'true'}
+        self.resource.process(message)
+
+        summary_message = {'session': str(self.session)}
+        self.resource.process(summary_message)
+
+        # Asserts
+        self.assertEqual({'OK': 2}, message['actions'])
+        self.assertNotIn('report_cache', message['session'])
+
+        self.resource.get_report.assert_called_once_with(session, False)
+        self.resource.mongodb.session.update_one.assert_called_once_with(
+            {'_id': self.session}, {'$set': {'report_cache.summary': {'actions': {'OK': 1}}}})
+
+    def test_set_cached_lru(self):
+        """The least recently used reports are evicted."""
+
+        Report.conf = {'api': {'report_cache_size': 2}}
+        Report.set_cached('a', {'a': 1})
+        Report.set_cached('b', {'b': 1})
+        Report.get_cached('a')
+        Report.set_cached('c', {'c': 1})
+
+        self.assertEqual(['a', 'c'], list(Report.cache))
+
+    def test_on_get_not_modified(self):
+        """If the cached report ETag matches, return a 304 without running anything."""
+
+        # Set up
+        etag = Report.set_cached((str(self.session), False), {'actions': {}})
+        request = MagicMock(params={'session': str(self.session)})
+        request.get_header.return_value = 'W/"{}"'.format(etag)
+        response = MagicMock()
+
+        # Actual call
+        with patch.object(Report, 'run_public') as run_public_mock:
+            Report.on_get(request, response)
+
+        # Asserts
+        self.assertEqual(falcon.HTTP_304, response.status)
+        self.assertEqual('"{}"'.format(etag), response.etag)
+        run_public_mock.assert_not_called()
+
+    def test_get_session_counts(self):
+        """The counts are queried concurrently."""
+
+        # Set up
+        def count(match):
+            gevent.sleep(0.05)
+            return 2
+
+        def aggregate(pipeline):
+            gevent.sleep(0.05)
+            return [{'_id': None, 'count': 1}]
+
+        self.resource.mongodb.__getitem__.return_value.count.side_effect = count
+        self.resource.mongodb.links.aggregate.side_effect = aggregate
+
+        # Actual call
+        start = time.monotonic()
+        counts = self.resource.get_session_counts(self._get_session())
+        elapsed = time.monotonic() - start
+
+        # Asserts
+        self.assertEqual({'links': 2, 'post': 2, 'occurrences': 2, 'sites': 1}, counts)
+        self.assertLess(elapsed, 0.1)
+
+    def test_get_report(self):
+        """The report parts are queried concurrently."""
+
+        # Set up
+        def part(value):
+            def side_effect(*args):
+                gevent.sleep(0.05)
+                return value
+
+            return Mock(side_effect=side_effect)
+
+        self.resource.audit_writer.rollups = False
+        self.resource.audit_writer.get_running.return_value = []
+        self.resource.audit_writer.get_collections.return_value = ['a_collection']
+        self.resource.get_action_summary = part({'OK': 1})
+        self.resource.get_last_activity = part('an_end_ts')
+        self.resource.get_session_counts = part({'links': 1})
+        self.resource.get_action_details = part({'an_action': {}})
+        session = self._get_session()
+
+        # Actual call
+        start = time.monotonic()
+        report = self.resource.get_report(session, True)
+        elapsed = time.monotonic() - start
+
+        # Asserts
+        expected = {
+            'actions': {'OK': 1},
+            'last_activity': 'an_end_ts',
+            'session_data': {'links': 1},
+            'details': {'an_action': {}}
+        }
+        self.assertEqual(expected, report)
+        self.assertLess(elapsed, 0.1)
+
+        match = {'session': self.session}
+        self.resource.get_action_summary.assert_called_once_with(match, [], ['a_collection'], None)
+        self.resource.get_last_activity.assert_called_once_with(match, ['a_collection'])
+        self.resource.get_session_counts.assert_called_once_with(session)
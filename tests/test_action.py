@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import threading
+import time
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import ANY, MagicMock, patch
 
+import gevent
+
+from smapy import utils
 from smapy.action import BaseAction
 
 
@@ -21,7 +26,7 @@ class TestBaseAction(TestCase):
                 """Modify the message."""
                 message['a'] = 'modified message'
 
-        api = MagicMock()
+        api = MagicMock(conf={})
         api.auditdb = MagicMock()
         TestAction.init(api)
 
@@ -54,7 +59,7 @@ class TestBaseAction(TestCase):
 
                 raise Exception("An Exception")
 
-        api = MagicMock()
+        api = MagicMock(conf={})
         api.auditdb = MagicMock()
         TestAction.init(api)
 
@@ -75,9 +80,9 @@ class TestBaseAction(TestCase):
         # Asserts
         exception = [
             'Traceback (most recent call last):\n',
-            '  File "{}smapy/action.py", line 63, in run_local\n'
-            '    self.process(message)\n'.format(project_dir),
-            '  File "{}tests/test_action.py", line 55, in process\n'
+            '  File "{}smapy/action.py", line 155, in run_local\n'
+            '    self.process(processed)\n'.format(project_dir),
+            '  File "{}tests/test_action.py", line 60, in process\n'
             '    raise Exception("An Exception")\n'.format(project_dir),
             'Exception: An Exception\n'
         ]
@@ -102,7 +107,7 @@ class TestBaseAction(TestCase):
 
                 raise SystemExit()
 
-        api = MagicMock()
+        api = MagicMock(conf={})
         api.auditdb = MagicMock()
         TestAction.init(api)
 
@@ -123,9 +128,9 @@ class TestBaseAction(TestCase):
         # Asserts
         exception = [
             'Traceback (most recent call last):\n',
-            '  File "{}smapy/action.py", line 63, in run_local\n'
-            '    self.process(message)\n'.format(project_dir),
-            '  File "{}tests/test_action.py", line 103, in process\n'
+            '  File "{}smapy/action.py", line 155, in run_local\n'
+            '    self.process(processed)\n'.format(project_dir),
+            '  File "{}tests/test_action.py", line 108, in process\n'
             '    raise SystemExit()\n'.format(project_dir),
             'SystemExit\n'
         ]
@@ -134,3 +139,317 @@ class TestBaseAction(TestCase):
         test_action.update_audit.assert_called_once_with({'a': 'modified message'}, exception)
 
         self.assertEqual(test_action.initial_message, {'a': 'message'})
+
+    # ################
+    # audit policies #
+    # ################
+    def _get_action(self, process=None, context=None, conf=None, **attrs):
+        class TestAction(BaseAction):
+            name = 'test_action'
+
+            def process(self, message):
+                if process:
+                    process(message)
+
+        for name, value in attrs.items():
+            setattr(TestAction, name, value)
+
+        api = MagicMock(conf=conf or {})
+        TestAction.init(api)
+
+        resource = MagicMock()
+        resource.context = dict(context or {}, session='a session')
+        return TestAction(resource)
+
+    def test_get_audit_policy(self):
+        """The action policy overrides the resource one, which overrides the conf one."""
+
+        conf = {'audit': {'sample_rate': 0.1, 'exceptions': True, 'slow_ms': 100}}
+        context = {'audit_sample_rate': 0.5, 'audit_slow_ms': 200}
+        test_action = self._get_action(context=context, conf=conf, audit_sample_rate=1)
+
+        self.assertEqual(1, test_action.get_audit_policy('sample_rate'))
+        self.assertEqual(200, test_action.get_audit_policy('slow_ms'))
+        self.assertTrue(test_action.get_audit_policy('exceptions'))
+
+    @patch('smapy.action.random')
+    def test_run_local_not_sampled(self, random_mock):
+        """If the call is not sampled and no other policy applies, nothing is written."""
+
+        # Set up
+        random_mock.random.return_value = 0.5
+        test_action = self._get_action(audit_sample_rate=0.1)
+
+        # Actual call
+        test_action.run_local({'a': 'message'})
+
+        # Asserts
+        test_action.audit_writer.start.assert_not_called()
+        test_action.audit_writer.insert.assert_not_called()
+        self.assertIsNone(test_action.initial_message)
+
+    @patch('smapy.action.random')
+    def test_run_local_sampled(self, random_mock):
+        """If the call is sampled, it is audited as usual."""
+
+        # Set up
+        random_mock.random.return_value = 0.05
+        test_action = self._get_action(audit_sample_rate=0.1)
+
+        # Actual call
+        test_action.run_local({'a': 'message'})
+
+        # Asserts
+        test_action.audit_writer.start.assert_called_once_with(ANY)
+        test_action.audit_writer.finish.assert_called_once_with(
+            test_action.audit_writer.start.return_value, ANY)
+
+    def test_run_local_exceptions_policy(self):
+        """A call which was not sampled but raised is audited with a single write."""
+
+        # Set up
+        def process(message):
+            message['a'] = 'modified message'
+            raise Exception('An Exception')
+
+        test_action = self._get_action(process, audit_sample_rate=0, audit_exceptions=True)
+
+        # Actual call
+        test_action.run_local({'a': 'message'})
+
+        # Asserts
+        test_action.audit_writer.start.assert_not_called()
+        test_action.audit_writer.insert.assert_called_once_with(ANY)
+
+        audit = test_action.audit_writer.insert.call_args[0][0]
+        self.assertEqual('EXCEPTION', audit['status'])
+        self.assertEqual('test_action', audit['action'])
+        self.assertEqual({'a': 'message'}, audit['request'])
+        self.assertEqual({'a': 'modified message'}, audit['message'])
+
+    def test_run_local_exceptions_policy_ok(self):
+        """A call which was not sampled and did not raise is not audited."""
+
+        # Set up
+        test_action = self._get_action(audit_sample_rate=0, audit_exceptions=True)
+
+        # Actual call
+        test_action.run_local({'a': 'message'})
+
+        # Asserts
+        test_action.audit_writer.insert.assert_not_called()
+
+    @patch('smapy.action.utils.get_ms')
+    def test_run_local_slow_ms_policy(self, get_ms_mock):
+        """A call which was not sampled but was slow is audited with a single write."""
+
+        # Set up
+        get_ms_mock.return_value = 150
+        test_action = self._get_action(conf={'audit': {'sample_rate': 0, 'slow_ms': 100}})
+
+        # Actual call
+        test_action.run_local({'a': 'message'})
+
+        # Asserts
+        audit = test_action.audit_writer.insert.call_args[0][0]
+        self.assertEqual('OK', audit['status'])
+        self.assertEqual(150, audit['elapsed'])
+
+    # ###############
+    # lazy snapshot #
+    # ###############
+    def test_run_local_lazy_snapshot_exception(self):
+        """In lazy snapshot mode, the initial message is rebuilt from the tracked values."""
+
+        # Set up
+        def process(message):
+            message['a'].append(2)
+            message['b'] = 'new'
+            raise Exception('An Exception')
+
+        conf = {'audit': {'snapshot': 'lazy'}}
+        test_action = self._get_action(process, conf=conf)
+
+        # Actual call
+        message = {'a': [1], 'c': [3]}
+        test_action.run_local(message)
+
+        # Asserts
+        self.assertEqual({'a': [1, 2], 'b': 'new', 'c': [3]}, message)
+        self.assertEqual(['a'], list(test_action.tracked_message.copies))
+
+        audit = test_action.audit_writer.finish.call_args[0][1]
+        self.assertEqual({'a': [1], 'c': [3]}, audit['request'])
+        self.assertIs(message, audit['message'])
+
+    @patch('smapy.action.utils.safecopy')
+    def test_run_local_lazy_snapshot_ok(self, safecopy_mock):
+        """In lazy snapshot mode, only the accessed values are copied."""
+
+        # Set up
+        def process(message):
+            message['b'] = message['a'] + 1
+
+        conf = {'audit': {'snapshot': 'lazy'}}
+        test_action = self._get_action(process, conf=conf)
+
+        # Actual call
+        message = {'a': 1, 'c': [3]}
+        test_action.run_local(message)
+
+        # Asserts
+        self.assertEqual({'a': 1, 'b': 2, 'c': [3]}, message)
+        safecopy_mock.assert_called_once_with(1)
+
+    def test_run_local_tracked_message(self):
+        """Messages which are already tracked are used as the snapshot."""
+
+        # Set up
+        def process(message):
+            message['a'].append(2)
+            raise Exception('An Exception')
+
+        test_action = self._get_action(process)
+
+        # Actual call
+        message = utils.TrackedDict({'a': [1], 'c': [3]})
+        test_action.run_local(message)
+
+        # Asserts
+        self.assertIs(message, test_action.tracked_message)
+        self.assertEqual(['a'], list(message.copies))
+
+        audit = test_action.audit_writer.finish.call_args[0][1]
+        self.assertEqual({'a': [1], 'c': [3]}, audit['request'])
+
+    # ###########
+    # cpu_bound #
+    # ###########
+    @patch('smapy.action.utils.safecopy')
+    @patch('smapy.action.executors.run_in_process')
+    def test_run_local_cpu_bound(self, run_in_process_mock, safecopy_mock):
+        """cpu_bound actions run in the process pool and their results are merged back."""
+
+        # Set up
+        run_in_process_mock.return_value = {'a': [1, 2], 'b': 'new'}
+        conf = {'api': {'process_pool_size': 2}, 'audit': {'snapshot': 'lazy'}}
+        test_action = self._get_action(conf=conf, cpu_bound=True)
+
+        # Actual call
+        message = {'a': [1], 'c': [3]}
+        test_action.run_local(message)
+
+        # Asserts
+        run_in_process_mock.assert_called_once_with(type(test_action), {'a': [1], 'c': [3]}, 2)
+        self.assertEqual({'a': [1, 2], 'b': 'new'}, message)
+        safecopy_mock.assert_not_called()
+        self.assertEqual({'a': [1], 'c': [3]}, test_action.get_initial_message())
+
+    # ##########
+    # blocking #
+    # ##########
+    def test_run_local_blocking(self):
+        """blocking actions run in the threadpool, without blocking the other greenlets."""
+
+        # Set up
+        def process(message):
+            time.sleep(0.1)    # Not patched by gevent
+            message['a'] = threading.current_thread().ident
+
+        test_action = self._get_action(process, blocking=True)
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(1)
+                gevent.sleep(0.01)
+
+        ticker = gevent.spawn(tick)
+        gevent.sleep(0)
+
+        # Actual call
+        message = {}
+        test_action.run_local(message)
+        ticker.kill()
+
+        # Asserts
+        self.assertNotEqual(threading.current_thread().ident, message['a'])
+        self.assertGreater(len(ticks), 5)
+
+    def test_run_local_lazy_snapshot_uncopyable(self):
+        """In lazy snapshot mode, values which cannot be copied do not make the action fail."""
+
+        # Set up
+        class Uncopyable(object):
+            def __deepcopy__(self, memo):
+                raise RecursionError('maximum recursion depth exceeded')
+
+        def process(message):
+            message['b'] = message['a']
+
+        conf = {'audit': {'snapshot': 'lazy'}}
+        test_action = self._get_action(process, conf=conf)
+
+        # Actual call
+        uncopyable = Uncopyable()
+        message = {'a': uncopyable}
+        test_action.run_local(message)
+
+        # Asserts
+        self.assertEqual({'a': uncopyable, 'b': uncopyable}, message)
+        audit = test_action.audit_writer.finish.call_args[0][1]
+        self.assertEqual('OK', audit['status'])
+
+    # ################
+    # shared message #
+    # ################
+    def test_run_local_lazy_snapshot_shared_message(self):
+        """Concurrent actions on a shared message only write back their own changes."""
+
+        # Set up
+        def process_a(message):
+            message['a'] = 1
+            gevent.sleep(0.01)
+
+        def process_b(message):
+            gevent.sleep(0.005)
+            message['b'] = 2
+            del message['y']
+
+        conf = {'audit': {'snapshot': 'lazy'}}
+        action_a = self._get_action(process_a, conf=conf)
+        action_b = self._get_action(process_b, conf=conf)
+
+        # Actual call
+        message = {'x': 0, 'y': 0}
+        gevent.joinall([
+            gevent.spawn(action_a.run_local, message),
+            gevent.spawn(action_b.run_local, message)
+        ], raise_error=True)
+
+        # Asserts
+        self.assertEqual({'x': 0, 'a': 1, 'b': 2}, message)
+
+    @patch('smapy.action.executors.run_in_process')
+    def test_run_local_cpu_bound_shared_message(self, run_in_process_mock):
+        """cpu_bound actions only merge back their own changes."""
+
+        # Set up
+        def run_in_process(action_class, message, max_workers):
+            gevent.sleep(0.01)
+            return dict(message, a=1)
+
+        run_in_process_mock.side_effect = run_in_process
+        conf = {'api': {}}
+        action_a = self._get_action(conf=conf, cpu_bound=True)
+        action_b = self._get_action(lambda message: message.update(b=2), conf=conf)
+
+        # Actual call
+        message = {'x': 0}
+        gevent.joinall([
+            gevent.spawn(action_a.run_local, message),
+            gevent.spawn(action_b.run_local, message)
+        ], raise_error=True)
+
+        # Asserts
+        self.assertEqual({'x': 0, 'a': 1, 'b': 2}, message)
@@ -3,11 +3,13 @@
 import traceback
 from importlib import reload
 from unittest import TestCase
-from unittest.mock import Mock, call, patch
+from unittest.mock import MagicMock, Mock, call, patch
 
 import falcon
+import gevent
+from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
 
-from smapy import api, middleware
+from smapy import api, audit, capture, middleware
 from smapy.actions import hello
 
 
@@ -213,6 +215,7 @@ class TestAPI(TestCase):
         # Override __init__
         api.API.__init__ = lambda x: None
         api_ = api.API()
+        api_._ensure_indexes = Mock()
 
         # Actual call
         api_._set_mongodb_up(conf)
@@ -223,6 +226,28 @@ class TestAPI(TestCase):
         self.assertEqual('a_database', api_.mongodb)
         self.assertEqual('a_database', api_.auditdb)
 
+        api_.indexes_greenlet.join()
+        api_._ensure_indexes.assert_called_once_with(api.API.INDEXES, True)
+
+    @patch('smapy.api.MongoClient')
+    def test__set_mongodb_up_unreachable(self, mongo_client_mock):
+        """The indexes are ensured in the background, without blocking the startup."""
+
+        # Set up
+        conf = {'mongodb': {'database': 'a_database'}}
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_._ensure_indexes = Mock(side_effect=lambda indexes, create: gevent.sleep(30))
+
+        # Actual call
+        api_._set_mongodb_up(conf)
+
+        # Asserts
+        self.assertFalse(api_.indexes_greenlet.ready())
+        api_.indexes_greenlet.kill()
+
     @patch('smapy.api.MongoClient')
     def test__set_mongodb_up_audit(self, mongo_client_mock):
         """If audit is defined, create a new client."""
@@ -248,6 +273,7 @@ class TestAPI(TestCase):
         # Override __init__
         api.API.__init__ = lambda x: None
         api_ = api.API()
+        api_._ensure_indexes = Mock()
 
         # Actual call
         api_._set_mongodb_up(conf)
@@ -263,6 +289,405 @@ class TestAPI(TestCase):
         self.assertEqual('a_database', api_.mongodb)
         self.assertEqual('audit_db', api_.auditdb)
 
+    @patch('smapy.api.MongoClient')
+    def test__set_mongodb_up_audit_no_connection(self, mongo_client_mock):
+        """If audit has no connection settings, reuse self.mongodb."""
+
+        # Set up
+        mongo_client_mock.return_value = {'a_database': 'a_database'}
+        conf = {
+            'mongodb': {
+                'host': 'a_host',
+                'port': 1234,
+                'database': 'a_database'
+            },
+            'audit': {
+                'write_behind': True
+            }
+        }
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_._ensure_indexes = Mock()
+
+        # Actual call
+        api_._set_mongodb_up(conf)
+
+        # Asserts
+        mongo_client_mock.assert_called_once_with(host='a_host', port=1234, connect=False)
+
+        self.assertEqual('a_database', api_.auditdb)
+
+    @patch('smapy.api.MongoClient')
+    def test__set_mongodb_up_shared_client(self, mongo_client_mock):
+        """Databases with the same connection settings share the client."""
+
+        # Set up
+        conf = {
+            'mongodb': {
+                'host': 'a_host',
+                'port': 1234,
+                'database': 'a_database',
+                'client_options': {'maxPoolSize': 10}
+            },
+            'audit': {
+                'host': 'a_host',
+                'port': 1234,
+                'database': 'audit_db',
+                'client_options': {'maxPoolSize': 10}
+            }
+        }
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_._ensure_indexes = Mock()
+
+        # Actual call
+        api_._set_mongodb_up(conf)
+
+        # Asserts
+        mongo_client_mock.assert_called_once_with(
+            host='a_host', port=1234, connect=False, maxPoolSize=10)
+        client = mongo_client_mock.return_value
+        self.assertEqual([call('a_database'), call('audit_db')], client.__getitem__.call_args_list)
+
+    def test__set_mongodb_up_audit_write_concerns(self):
+        """The audit write concerns are applied to the same database."""
+
+        # Set up
+        conf = {
+            'mongodb': {
+                'database': 'a_database',
+                'write_concerns': {'session': {'w': 'majority'}}
+            },
+            'audit': {
+                'write_concerns': {'actions': {'w': 0}}
+            }
+        }
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_._ensure_indexes = Mock()
+
+        # Actual call
+        api_._set_mongodb_up(conf)
+
+        # Asserts
+        self.assertEqual(1, len(api_.mongo_clients))
+        self.assertEqual('a_database', api_.auditdb.name)
+        self.assertIs(api_.mongodb.client, api_.auditdb.client)
+        self.assertEqual({'w': 'majority'}, api_.mongodb.session.write_concern.document)
+        self.assertEqual({}, api_.mongodb.actions.write_concern.document)
+        self.assertEqual({'w': 0}, api_.auditdb['actions'].write_concern.document)
+        self.assertEqual({'w': 0}, api_.auditdb.actions_20180101.write_concern.document)
+        self.assertEqual({'w': 0}, api_.auditdb['actions_2018_w01'].write_concern.document)
+        self.assertEqual({}, api_.auditdb['action_rollups'].write_concern.document)
+
+    # #########################
+    # _get_conf_indexes(conf) #
+    # #########################
+    def test__get_conf_indexes_none(self):
+        """By default, nothing expires."""
+        conf = {'mongodb': {}, 'audit': {}}
+
+        self.assertEqual([], api.API._get_conf_indexes(conf))
+
+    def test__get_conf_indexes(self):
+        """Expire sessions by in_ts and action audits by start_ts."""
+        conf = {
+            'mongodb': {'session_ttl': 3600},
+            'audit': {'actions_ttl': 60},
+        }
+
+        expected = [
+            ('mongodb', 'session', [('in_ts', 1)], {'expireAfterSeconds': 3600}),
+            ('auditdb', 'actions', [('start_ts', 1)], {'expireAfterSeconds': 60}),
+        ]
+        self.assertEqual(expected, api.API._get_conf_indexes(conf))
+
+    def test__get_conf_indexes_rollups(self):
+        """Action rollups are unique by session and action."""
+        conf = {
+            'mongodb': {},
+            'audit': {'rollups': True},
+        }
+
+        expected = [
+            ('auditdb', 'action_rollups', [('session', 1), ('action', 1)], {'unique': True}),
+        ]
+        self.assertEqual(expected, api.API._get_conf_indexes(conf))
+
+    def test__get_conf_indexes_rollups_ttl(self):
+        """Action rollups expire by update_ts, even if the action audits are bucketed."""
+        conf = {
+            'mongodb': {},
+            'audit': {'rollups': True, 'actions_ttl': 60, 'bucket': 'day'},
+        }
+
+        expected = [
+            ('auditdb', 'action_rollups', [('session', 1), ('action', 1)], {'unique': True}),
+            ('auditdb', 'action_rollups', [('update_ts', 1)], {'expireAfterSeconds': 60}),
+        ]
+        self.assertEqual(expected, api.API._get_conf_indexes(conf))
+
+    def test__get_conf_indexes_bucket(self):
+        """If actions are bucketed, expired buckets are dropped instead."""
+        conf = {
+            'mongodb': {},
+            'audit': {'actions_ttl': 60, 'bucket': 'day'},
+        }
+
+        self.assertEqual([], api.API._get_conf_indexes(conf))
+
+    # #############################################
+    # _ensure_indexes(self, indexes, create=True) #
+    # #############################################
+    def test__ensure_indexes_create(self):
+        """Create all the declared indexes."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.mongodb = MagicMock()
+        api_.auditdb = MagicMock()
+        indexes = [
+            ('mongodb', 'a_collection', [('a', 1)], {'expireAfterSeconds': 60}),
+            ('auditdb', 'another_collection', [('b', 1), ('_id', -1)], {}),
+        ]
+
+        # Actual call
+        missing = api_._ensure_indexes(indexes)
+
+        # Asserts
+        self.assertEqual([], missing)
+        api_.mongodb['a_collection'].create_index.assert_called_once_with(
+            [('a', 1)], background=True, expireAfterSeconds=60)
+        api_.auditdb['another_collection'].create_index.assert_called_once_with(
+            [('b', 1), ('_id', -1)], background=True)
+
+    def test__ensure_indexes_create_error(self):
+        """If an index cannot be created, report it as missing."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.mongodb = MagicMock()
+        collection = api_.mongodb['a_collection']
+        collection.full_name = 'smapy.a_collection'
+        collection.create_index.side_effect = PyMongoError('an error')
+        indexes = [('mongodb', 'a_collection', [('a', 1)], {})]
+
+        # Actual call
+        with self.assertLogs('smapy.api'):
+            missing = api_._ensure_indexes(indexes)
+
+        # Asserts
+        self.assertEqual([('smapy.a_collection', [('a', 1)])], missing)
+
+    def test__ensure_indexes_unreachable(self):
+        """If MongoDB is unreachable, the remaining indexes are not tried."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.mongodb = MagicMock()
+        collection = api_.mongodb['a_collection']
+        collection.full_name = 'smapy.a_collection'
+        collection.create_index.side_effect = ServerSelectionTimeoutError('unreachable')
+        indexes = [
+            ('mongodb', 'a_collection', [('a', 1)], {}),
+            ('mongodb', 'a_collection', [('b', 1)], {}),
+        ]
+
+        # Actual call
+        with self.assertLogs('smapy.api'):
+            missing = api_._ensure_indexes(indexes)
+
+        # Asserts
+        expected = [('smapy.a_collection', [('a', 1)]), ('smapy.a_collection', [('b', 1)])]
+        self.assertEqual(expected, missing)
+        collection.create_index.assert_called_once_with([('a', 1)], background=True)
+
+    def test__ensure_indexes_check(self):
+        """If create is False, only report the missing indexes."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.mongodb = MagicMock()
+        collection = api_.mongodb['a_collection']
+        collection.full_name = 'smapy.a_collection'
+        collection.index_information.return_value = {
+            '_id_': {'key': [('_id', 1)]},
+            'a_1': {'key': [('a', 1.0)]},
+        }
+        indexes = [
+            ('mongodb', 'a_collection', [('a', 1)], {}),
+            ('mongodb', 'a_collection', [('b', 1)], {}),
+        ]
+
+        # Actual call
+        with self.assertLogs('smapy.api'):
+            missing = api_._ensure_indexes(indexes, False)
+
+        # Asserts
+        self.assertEqual([('smapy.a_collection', [('b', 1)])], missing)
+        collection.create_index.assert_not_called()
+
+    # ##################################
+    # _set_audit_writer_up(self, conf) #
+    # ##################################
+    @patch('smapy.api.atexit')
+    def test__set_audit_writer_up_default(self, atexit_mock):
+        """By default, audit documents are written synchronously."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        api_._set_audit_writer_up({'audit': {'database': 'audit_db'}})
+
+        # Asserts
+        self.assertIs(type(api_.audit_writer), audit.MongoAuditWriter)
+        self.assertEqual(api_.auditdb, api_.audit_writer.auditdb)
+        self.assertFalse(api_.audit_writer.single)
+        atexit_mock.register.assert_called_once_with(api_.audit_writer.close)
+
+    @patch('smapy.api.atexit')
+    def test__set_audit_writer_up_single(self, atexit_mock):
+        """In single mode, the audit writer only writes finished actions."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        api_._set_audit_writer_up({'audit': {'mode': 'single'}})
+
+        # Asserts
+        self.assertTrue(api_.audit_writer.single)
+
+    def test__set_audit_writer_up_invalid_mode(self):
+        """An unknown audit mode is rejected."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        with self.assertRaises(ValueError) as ve:
+            api_._set_audit_writer_up({'audit': {'mode': 'an_invalid_mode'}})
+
+        # Asserts
+        self.assertEqual('Invalid audit mode: an_invalid_mode', str(ve.exception))
+
+    @patch('smapy.api.atexit')
+    @patch('smapy.api.BulkMongoAuditWriter')
+    def test__set_audit_writer_up_write_behind(self, bulk_writer_mock, atexit_mock):
+        """If write_behind is enabled, use a BulkMongoAuditWriter."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        conf = {
+            'audit': {
+                'write_behind': True,
+                'bulk_size': 100,
+                'flush_interval': 0.5
+            }
+        }
+        api_._set_audit_writer_up(conf)
+
+        # Asserts
+        bulk_writer_mock.assert_called_once_with(
+            api_.auditdb, bulk_size=100, flush_interval=0.5, max_size=None,
+            single=False, bucket=None, ttl=None, rollups=False)
+        self.assertEqual(bulk_writer_mock.return_value, api_.audit_writer)
+        atexit_mock.register.assert_called_once_with(bulk_writer_mock.return_value.close)
+
+    @patch('smapy.api.atexit')
+    @patch('smapy.api.LogAuditWriter')
+    def test__set_audit_writer_up_log(self, log_writer_mock, atexit_mock):
+        """The log backend writes the audits into a local file."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        conf = {
+            'audit': {
+                'backend': 'log',
+                'path': '/tmp/audit-{pid}.log',
+                'max_bytes': 1024
+            }
+        }
+        api_._set_audit_writer_up(conf)
+
+        # Asserts
+        log_writer_mock.assert_called_once_with(
+            '/tmp/audit-{pid}.log', max_bytes=1024, backup_count=5, single=False)
+        self.assertEqual(log_writer_mock.return_value, api_.audit_writer)
+        atexit_mock.register.assert_called_once_with(log_writer_mock.return_value.close)
+
+    @patch('smapy.api.atexit')
+    @patch('smapy.api.SqliteAuditWriter')
+    def test__set_audit_writer_up_sqlite(self, sqlite_writer_mock, atexit_mock):
+        """The sqlite backend writes the audits into a local database."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        api_._set_audit_writer_up({'audit': {'backend': 'sqlite', 'mode': 'single'}})
+
+        # Asserts
+        sqlite_writer_mock.assert_called_once_with('audit-{pid}.sqlite', single=True)
+        self.assertEqual(sqlite_writer_mock.return_value, api_.audit_writer)
+
+    @patch('smapy.api.atexit')
+    def test__set_audit_writer_up_null(self, atexit_mock):
+        """The null backend discards the audits."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        api_._set_audit_writer_up({'audit': {'backend': 'null'}})
+
+        # Asserts
+        self.assertIs(type(api_.audit_writer), audit.NullAuditWriter)
+
+    def test__set_audit_writer_up_invalid_backend(self):
+        """An unknown audit backend is rejected."""
+
+        # Override __init__
+        api.API.__init__ = lambda x: None
+        api_ = api.API()
+        api_.auditdb = Mock()
+
+        # Actual call
+        with self.assertRaises(ValueError) as ve:
+            api_._set_audit_writer_up({'audit': {'backend': 'an_invalid_backend'}})
+
+        # Asserts
+        self.assertEqual('Invalid audit backend: an_invalid_backend', str(ve.exception))
+
     # ######################
     # __init__(self, conf) #
     # ######################
@@ -272,31 +697,41 @@ class TestAPI(TestCase):
 
         # Set up
         conf = {
-            'mongodb': 'mongodb',
-            'audit': 'auditdb',
+            'mongodb': {'database': 'mongodb'},
+            'audit': {'database': 'auditdb'},
             'api': {
                 'endpoint': 'an_endpoint',
-                'default_resources': False
+                'default_resources': False,
+                'threadpool_size': 4
             }
         }
+        threadpool = gevent.get_hub().threadpool
+        self.addCleanup(setattr, threadpool, 'maxsize', threadpool.maxsize)
 
         # Mock _get_mongodb and _add_runnable
         def _get_mongodb(conf):
             return conf
 
         api.API._get_mongodb = Mock(side_effect=_get_mongodb)
+        api.API._ensure_indexes = Mock()
         api.API.add_route = Mock()
 
         # Actual call
         api_ = api.API(conf)
 
         # Asserts
+        self.assertEqual(4, threadpool.maxsize)
+
         _get_mongodb_calls = [
-            call('mongodb'),
-            call('auditdb')
+            call({'database': 'mongodb'}),
+            call({'database': 'auditdb'})
         ]
         self.assertEqual(_get_mongodb_calls, api_._get_mongodb.call_args_list)
 
+        self.assertIsInstance(api_.audit_writer, audit.MongoAuditWriter)
+        self.assertEqual({'database': 'auditdb'}, api_.audit_writer.auditdb)
+        self.assertIsInstance(api_.session_capture, capture.SessionCapture)
+
         # This is a bit hacky.
         # Here we go into the API._middleware list and look for the classes
         # which the registered methods belong to.
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import sqlite3
+import tempfile
+from collections import defaultdict
+from unittest import TestCase
+from unittest.mock import ANY, MagicMock, call, patch
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import PyMongoError
+
+from smapy.audit import (
+    BulkMongoAuditWriter, LogAuditWriter, MongoAuditWriter, NullAuditWriter, SqliteAuditWriter)
+
+
+class TestNullAuditWriter(TestCase):
+
+    def test_single(self):
+        """Nothing is written, but the running actions are still tracked."""
+
+        # Set up
+        writer = NullAuditWriter(single=True)
+
+        # Actual call
+        aid = writer.start({'session': 'a_session', 'status': 'RUNNING'})
+        running = [dict(audit) for audit in writer.get_running('a_session')]
+        writer.finish(aid, {'status': 'OK'})
+
+        # Asserts
+        self.assertIsInstance(aid, ObjectId)
+        self.assertEqual([{'_id': aid, 'session': 'a_session', 'status': 'RUNNING'}], running)
+        self.assertEqual([], writer.get_running('a_session'))
+        self.assertEqual([], writer.get_collections(datetime.datetime.utcnow()))
+        self.assertFalse(writer.rollups)
+
+
+class TestLogAuditWriter(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'audit-{pid}.log')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_insert_update(self):
+        """The writes are appended to the file of the worker as BSON documents."""
+
+        # Set up
+        writer = LogAuditWriter(self.path)
+
+        # Actual call
+        aid = writer.insert({'status': 'RUNNING'})
+        writer.update(aid, {'status': 'OK'})
+        writer.close()
+
+        # Asserts
+        path = self.path.format(pid=os.getpid())
+        self.assertEqual(path, writer.path)
+        expected = [
+            {'op': 'insert', '_id': aid, 'audit': {'_id': aid, 'status': 'RUNNING'}},
+            {'op': 'update', '_id': aid, 'audit': {'status': 'OK'}},
+        ]
+        self.assertEqual(expected, list(LogAuditWriter.read(path)))
+
+    def test_rotate(self):
+        """When the file reaches max_bytes, it is rotated keeping backup_count files."""
+
+        # Set up
+        writer = LogAuditWriter(self.path, max_bytes=1, backup_count=2)
+
+        # Actual call
+        aids = [writer.insert({'status': 'OK'}) for _ in range(4)]
+        writer.close()
+
+        # Asserts
+        path = writer.path
+        self.assertEqual(0, os.path.getsize(path))
+        self.assertEqual(aids[3], next(LogAuditWriter.read(path + '.1'))['_id'])
+        self.assertEqual(aids[2], next(LogAuditWriter.read(path + '.2'))['_id'])
+        self.assertFalse(os.path.exists(path + '.3'))
+
+
+class TestSqliteAuditWriter(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'audit-{pid}.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_insert_update(self):
+        """The audits are stored as rows of the actions table."""
+
+        # Set up
+        writer = SqliteAuditWriter(self.path)
+        session = ObjectId()
+
+        # Actual call
+        aid = writer.insert({'session': session, 'action': 'an_action', 'status': 'RUNNING'})
+        writer.update(aid, {'status': 'OK', 'elapsed': 1.5})
+        writer.close()
+
+        # Asserts
+        connection = sqlite3.connect(self.path.format(pid=os.getpid()))
+        rows = connection.execute('SELECT id, action, session, status, elapsed FROM actions')
+        self.assertEqual([(str(aid), 'an_action', str(session), 'OK', 1.5)], list(rows))
+        connection.close()
+
+
+class TestMongoAuditWriter(TestCase):
+
+    def test_insert_update(self):
+        """Each audit write goes straight into the actions collection."""
+
+        # Set up
+        auditdb = MagicMock()
+        auditdb['actions'].insert.return_value = 'an_aid'
+        writer = MongoAuditWriter(auditdb)
+
+        # Actual call
+        aid = writer.insert({'status': 'RUNNING'})
+        writer.update(aid, {'status': 'OK'})
+
+        # Asserts
+        self.assertEqual('an_aid', aid)
+        auditdb['actions'].insert.assert_called_once_with({'status': 'RUNNING'})
+        auditdb['actions'].update.assert_called_once_with(
+            {'_id': 'an_aid'}, {'$set': {'status': 'OK'}})
+
+    def test_start_finish_update(self):
+        """By default, a RUNNING audit is inserted and then updated."""
+
+        # Set up
+        auditdb = MagicMock()
+        auditdb['actions'].insert.return_value = 'an_aid'
+        writer = MongoAuditWriter(auditdb)
+
+        # Actual call
+        aid = writer.start({'session': 'a_session', 'status': 'RUNNING'})
+        running = writer.get_running('a_session')
+        writer.finish(aid, {'status': 'OK'})
+
+        # Asserts
+        self.assertEqual('an_aid', aid)
+        self.assertEqual([], running)
+        auditdb['actions'].insert.assert_called_once_with(
+            {'session': 'a_session', 'status': 'RUNNING'})
+        auditdb['actions'].update.assert_called_once_with(
+            {'_id': 'an_aid'}, {'$set': {'status': 'OK'}})
+
+    def test_start_finish_single(self):
+        """In single mode, the audit is kept in memory and inserted once finished."""
+
+        # Set up
+        auditdb = MagicMock()
+        writer = MongoAuditWriter(auditdb, single=True)
+
+        # Actual call
+        aid = writer.start({'session': 'a_session', 'status': 'RUNNING'})
+        writer.start({'session': 'another_session', 'status': 'RUNNING'})
+        running = writer.get_running('a_session')
+
+        self.assertIsInstance(aid, ObjectId)
+        self.assertEqual([{'_id': aid, 'session': 'a_session', 'status': 'RUNNING'}], running)
+        auditdb['actions'].insert.assert_not_called()
+
+        writer.finish(aid, {'status': 'OK'})
+
+        # Asserts
+        self.assertEqual([], writer.get_running('a_session'))
+
+        auditdb['actions'].insert.assert_called_once_with(
+            {'_id': aid, 'session': 'a_session', 'status': 'OK'})
+        auditdb['actions'].update.assert_not_called()
+
+    def test_invalid_bucket(self):
+        with self.assertRaises(ValueError):
+            MongoAuditWriter(MagicMock(), bucket='an_invalid_bucket')
+
+    def test_insert_update_bucket(self):
+        """Audits are written into the bucket of the generation time of their _id."""
+
+        # Set up
+        auditdb = MagicMock()
+        writer = MongoAuditWriter(auditdb, bucket='day')
+        aid = ObjectId.from_datetime(datetime.datetime(2018, 3, 4, 12))
+
+        # Actual call
+        writer.insert({'_id': aid, 'status': 'RUNNING'})
+        writer.update(aid, {'status': 'OK'})
+
+        # Asserts
+        self.assertEqual({'actions_20180304'}, writer.buckets)
+        auditdb['actions_20180304'].create_index.assert_called_once_with(
+            [('session', 1), ('_id', -1)], background=True)
+
+        auditdb.__getitem__.assert_called_with('actions_20180304')
+        auditdb['actions_20180304'].insert.assert_called_once_with(
+            {'_id': aid, 'status': 'RUNNING'})
+        auditdb['actions_20180304'].update.assert_called_once_with(
+            {'_id': aid}, {'$set': {'status': 'OK'}})
+
+    def test_bucket_ttl(self):
+        """When a new bucket is created, the expired ones are dropped."""
+
+        # Set up
+        auditdb = MagicMock()
+        today = datetime.datetime.utcnow()
+        old = today - datetime.timedelta(days=3)
+        auditdb.list_collection_names.return_value = [
+            'actions_' + old.strftime('%Y%m%d'),
+            'actions_' + today.strftime('%Y%m%d'),
+            'session',
+        ]
+        writer = MongoAuditWriter(auditdb, bucket='day', ttl=24 * 3600)
+
+        # Actual call
+        writer.insert({'status': 'RUNNING'})
+
+        # Asserts
+        auditdb.drop_collection.assert_called_once_with('actions_' + old.strftime('%Y%m%d'))
+
+    def test_get_collections(self):
+        auditdb = MagicMock()
+        writer = MongoAuditWriter(auditdb)
+
+        collections = writer.get_collections(datetime.datetime(2018, 3, 4))
+
+        self.assertEqual([auditdb['actions']], collections)
+
+    def test_get_collections_bucket(self):
+        """Get all the buckets between start and end."""
+
+        # Set up
+        auditdb = MagicMock()
+        auditdb.__getitem__.side_effect = lambda name: name
+        writer = MongoAuditWriter(auditdb, bucket='week')
+
+        # Actual call
+        start = datetime.datetime(2018, 3, 4, 23)
+        end = datetime.datetime(2018, 3, 13, 1)
+        collections = writer.get_collections(start, end)
+
+        # Asserts
+        self.assertEqual(['actions_2018_w09', 'actions_2018_w10', 'actions_2018_w11'], collections)
+
+    def test_rollups(self):
+        """Each audit write also updates the action rollup counters."""
+
+        # Set up
+        collections = defaultdict(MagicMock)
+        auditdb = MagicMock()
+        auditdb.__getitem__.side_effect = collections.__getitem__
+        collections['actions'].insert.return_value = 'an_aid'
+        writer = MongoAuditWriter(auditdb, rollups=True)
+
+        # Actual call
+        audit = {'session': 'a_session', 'action': 'an.action', 'status': 'RUNNING'}
+        aid = writer.start(audit)
+        writer.finish(aid, {'status': 'OK', 'elapsed': 10})
+
+        # Asserts
+        match = {'session': 'a_session', 'action': 'an.action'}
+        expected = [
+            call(match, {'$inc': {'called': 1}, '$max': {'update_ts': ANY}}, upsert=True),
+            call(
+                match,
+                {'$inc': {'OK': 1, 'total_ms': 10}, '$max': {'update_ts': ANY, 'max_ms': 10}},
+                upsert=True
+            ),
+        ]
+        self.assertEqual(expected, collections['action_rollups'].update_one.call_args_list)
+        self.assertEqual({}, writer.rolling)
+
+    def test_rollups_single(self):
+        """In single mode, the whole rollup is updated at once."""
+
+        # Set up
+        collections = defaultdict(MagicMock)
+        auditdb = MagicMock()
+        auditdb.__getitem__.side_effect = collections.__getitem__
+        writer = MongoAuditWriter(auditdb, single=True, rollups=True)
+
+        # Actual call
+        audit = {'session': 'a_session', 'action': 'an.action', 'status': 'RUNNING'}
+        aid = writer.start(audit)
+        writer.finish(aid, {'status': 'EXCEPTION', 'elapsed': 10})
+
+        # Asserts
+        collections['action_rollups'].update_one.assert_called_once_with(
+            {'session': 'a_session', 'action': 'an.action'},
+            {
+                '$inc': {'called': 1, 'EXCEPTION': 1, 'total_ms': 10},
+                '$max': {'update_ts': ANY, 'max_ms': 10}
+            },
+            upsert=True
+        )
+
+
+@patch('smapy.audit.gevent')
+class TestBulkMongoAuditWriter(TestCase):
+
+    def test_insert_update_buffered(self, gevent_mock):
+        """Writes are buffered and the _id is generated client side."""
+
+        # Set up
+        auditdb = MagicMock()
+        writer = BulkMongoAuditWriter(auditdb, bulk_size=10)
+
+        # Actual call
+        aid = writer.insert({'status': 'RUNNING'})
+        writer.update(aid, {'status': 'OK'})
+
+        # Asserts
+        self.assertIsInstance(aid, ObjectId)
+        auditdb['actions'].insert.assert_not_called()
+        auditdb['actions'].update.assert_not_called()
+        auditdb['actions'].bulk_write.assert_not_called()
+
+        expected = [
+            ('actions', InsertOne({'_id': aid, 'status': 'RUNNING'})),
+            ('actions', UpdateOne({'_id': aid}, {'$set': {'status': 'OK'}})),
+        ]
+        self.assertEqual(expected, writer.requests)
+
+    def test_flush(self, gevent_mock):
+        """The buffered writes are sent in a single ordered bulk_write."""
+
+        # Set up
+        auditdb = MagicMock()
+        writer = BulkMongoAuditWriter(auditdb)
+        aid = writer.insert({'status': 'RUNNING'})
+        writer.update(aid, {'status': 'OK'})
+        requests = [request for _, request in writer.requests]
+
+        # Actual call
+        writer.flush()
+        writer.flush()
+
+        # Asserts
+        auditdb['actions'].bulk_write.assert_called_once_with(requests, ordered=True)
+        self.assertEqual([], writer.requests)
+
+    def test_flush_error(self, gevent_mock):
+        """If the bulk_write fails, the error is logged and the writes dropped."""
+
+        # Set up
+        auditdb = MagicMock()
+        auditdb['actions'].bulk_write.side_effect = PyMongoError('an error')
+        writer = BulkMongoAuditWriter(auditdb)
+        writer.insert({'status': 'RUNNING'})
+
+        # Actual call
+        with self.assertLogs('smapy.audit'):
+            writer.flush()
+
+        # Asserts
+        self.assertEqual([], writer.requests)
+
+    def test_flush_bucket(self, gevent_mock):
+        """The buffered writes are sent to each bucket in order."""
+
+        # Set up
+        collections = defaultdict(MagicMock)
+        auditdb = MagicMock()
+        auditdb.__getitem__.side_effect = collections.__getitem__
+        writer = BulkMongoAuditWriter(auditdb, bucket='day')
+        first = ObjectId.from_datetime(datetime.datetime(2018, 3, 4, 23, 59))
+        second = ObjectId.from_datetime(datetime.datetime(2018, 3, 5))
+        writer.insert({'_id': first})
+        writer.insert({'_id': second})
+        writer.update(first, {'status': 'OK'})
+
+        # Actual call
+        writer.flush()
+
+        # Asserts
+        collections['actions_20180304'].bulk_write.assert_called_once_with(
+            [InsertOne({'_id': first}), UpdateOne({'_id': first}, {'$set': {'status': 'OK'}})],
+            ordered=True)
+        collections['actions_20180305'].bulk_write.assert_called_once_with(
+            [InsertOne({'_id': second})], ordered=True)
+
+    def test_flush_rollups(self, gevent_mock):
+        """The rollup counters are added up and written once per flush."""
+
+        # Set up
+        collections = defaultdict(MagicMock)
+        auditdb = MagicMock()
+        auditdb.__getitem__.side_effect = collections.__getitem__
+        writer = BulkMongoAuditWriter(auditdb, rollups=True)
+
+        for elapsed in (10, 30, 20):
+            audit = {'session': 'a_session', 'action': 'an.action', 'status': 'RUNNING'}
+            aid = writer.start(audit)
+            writer.finish(aid, {'status': 'OK', 'elapsed': elapsed})
+
+        # Actual call
+        writer.flush()
+
+        # Asserts
+        collections['actions'].bulk_write.assert_called_once_with(ANY, ordered=True)
+        collections['action_rollups'].bulk_write.assert_called_once_with([
+            UpdateOne(
+                {'session': 'a_session', 'action': 'an.action'},
+                {
+                    '$inc': {'called': 3, 'OK': 3, 'total_ms': 60},
+                    '$max': {'update_ts': ANY, 'max_ms': 30}
+                },
+                upsert=True
+            )
+        ], ordered=False)
+        self.assertEqual({}, writer.pending_rollups)
+
+    def test_bulk_size(self, gevent_mock):
+        """When bulk_size writes are buffered, a background flush is spawned."""
+
+        # Set up
+        auditdb = MagicMock()
+        writer = BulkMongoAuditWriter(auditdb, bulk_size=2)
+        gevent_mock.spawn.reset_mock()
+
+        # Actual call
+        writer.insert({'status': 'RUNNING'})
+        writer.insert({'status': 'RUNNING'})
+
+        # Asserts
+        gevent_mock.spawn.assert_called_once_with(writer.flush)
+        auditdb['actions'].bulk_write.assert_not_called()
+
+    def test_max_size(self, gevent_mock):
+        """When max_size writes are buffered, flush before returning."""
+
+        # Set up
+        auditdb = MagicMock()
+        writer = BulkMongoAuditWriter(auditdb, bulk_size=1, max_size=2)
+
+        # Actual call
+        writer.insert({'status': 'RUNNING'})
+        writer.insert({'status': 'RUNNING'})
+
+        # Asserts
+        self.assertEqual(1, auditdb['actions'].bulk_write.call_count)
+        self.assertEqual([], writer.requests)
+
+    def test_close(self, gevent_mock):
+        """Stop the periodic flush and write the pending requests."""
+
+        # Set up
+        auditdb = MagicMock()
+        writer = BulkMongoAuditWriter(auditdb)
+        writer.insert({'status': 'RUNNING'})
+
+        # Actual call
+        writer.close()
+
+        # Asserts
+        writer.flusher.kill.assert_called_once_with()
+        self.assertEqual(1, auditdb['actions'].bulk_write.call_count)
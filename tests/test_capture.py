@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from bson import BSON
+
+from smapy.capture import SessionCapture
+
+
+class TestSessionCapture(TestCase):
+
+    def setUp(self):
+        self.value = {'a': 'x' * 100, 'b': 'y'}
+        self.data = BSON.encode({'value': self.value})
+
+    def test_invalid_overflow(self):
+        with self.assertRaises(ValueError):
+            SessionCapture(overflow='an_invalid_overflow')
+
+    def test_from_conf(self):
+        conf = {
+            'session_max_size': 1024,
+            'session_overflow': 'hash',
+            'session_body_fields': ['a'],
+        }
+        capture = SessionCapture.from_conf(conf, 'a_mongodb')
+
+        self.assertEqual(1024, capture.max_size)
+        self.assertEqual('hash', capture.overflow)
+        self.assertEqual({'body': ['a']}, capture.allowlists)
+        self.assertEqual('a_mongodb', capture.mongodb)
+
+    def test_capture_unlimited(self):
+        """By default, values are stored as they are."""
+        capture = SessionCapture()
+
+        self.assertIs(self.value, capture.capture('body', self.value))
+
+    def test_capture_allowlist(self):
+        capture = SessionCapture(allowlists={'body': ['b', 'c']})
+
+        self.assertEqual({'b': 'y'}, capture.capture('body', self.value))
+        self.assertEqual(self.value, capture.capture('response', self.value))
+
+    def test_capture_small(self):
+        capture = SessionCapture(max_size=1024)
+
+        self.assertIs(self.value, capture.capture('body', self.value))
+
+    def test_capture_truncate(self):
+        capture = SessionCapture(max_size=50)
+
+        captured = capture.capture('body', self.value)
+
+        self.assertEqual(len(self.data), captured['size'])
+        self.assertEqual(hashlib.sha1(self.data).hexdigest(), captured['sha1'])
+        self.assertEqual('{"a": "xxx', captured['preview'][:10])
+        self.assertEqual(50, len(captured['preview']))
+
+    def test_capture_hash(self):
+        capture = SessionCapture(max_size=50, overflow='hash')
+
+        captured = capture.capture('body', self.value)
+
+        expected = {
+            'size': len(self.data),
+            'sha1': hashlib.sha1(self.data).hexdigest(),
+        }
+        self.assertEqual(expected, captured)
+
+    def test_capture_zlib(self):
+        capture = SessionCapture(max_size=100, overflow='zlib')
+
+        captured = capture.capture('body', self.value)
+
+        self.assertIn('zlib', captured)
+        self.assertNotIn('preview', captured)
+        self.assertEqual(self.value, capture.load(captured))
+
+    def test_capture_zlib_too_big(self):
+        """If the compressed value still does not fit, it is truncated."""
+        capture = SessionCapture(max_size=10, overflow='zlib')
+
+        captured = capture.capture('body', self.value)
+
+        self.assertNotIn('zlib', captured)
+        self.assertEqual(10, len(captured['preview']))
+
+    @patch('smapy.capture.gridfs')
+    def test_capture_gridfs(self, gridfs_mock):
+        gridfs_mock.GridFS.return_value.put.return_value = 'a_file_id'
+        capture = SessionCapture(max_size=50, overflow='gridfs', mongodb='a_mongodb')
+
+        captured = capture.capture('body', self.value)
+
+        gridfs_mock.GridFS.assert_called_once_with('a_mongodb', 'session_capture')
+        gridfs_mock.GridFS.return_value.put.assert_called_once_with(self.data)
+        self.assertEqual('a_file_id', captured['gridfs'])
+
+        gridfs_mock.GridFS.return_value.get.return_value = MagicMock(
+            read=MagicMock(return_value=self.data))
+        self.assertEqual(self.value, capture.load(captured))
+        gridfs_mock.GridFS.return_value.get.assert_called_once_with('a_file_id')
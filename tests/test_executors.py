@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from smapy import executors
+from smapy.action import BaseAction
+
+
+class SumAction(BaseAction):
+
+    def process(self, message):
+        message['pid'] = os.getpid()
+        message['total'] = sum(message['values'])
+        message['values'].append(message['total'])
+
+
+class FailingAction(BaseAction):
+
+    def process(self, message):
+        raise ValueError('A failure')
+
+
+class TestExecutors(TestCase):
+
+    def test_get_process_pool(self):
+        """The process pool is created once per worker process."""
+
+        # Actual call
+        pool = executors.get_process_pool(1)
+
+        # Asserts
+        self.assertIs(pool, executors.get_process_pool(1))
+        with patch('smapy.executors.os.getpid', return_value=-1):
+            self.assertIsNot(pool, executors.get_process_pool(1))
+
+    def test_run_in_process(self):
+        """process runs in another process, on a copy of the message."""
+
+        # Set up
+        message = {'values': [1, 2, 3]}
+
+        # Actual call
+        processed = executors.run_in_process(SumAction, message, 1)
+
+        # Asserts
+        self.assertEqual({'values': [1, 2, 3]}, message)
+        self.assertEqual(6, processed['total'])
+        self.assertEqual([1, 2, 3, 6], processed['values'])
+        self.assertNotEqual(os.getpid(), processed['pid'])
+
+    def test_run_in_process_exception(self):
+        """The exceptions raised by process are raised back."""
+
+        # Actual call
+        with self.assertRaises(ValueError) as ve:
+            executors.run_in_process(FailingAction, {}, 1)
+
+        # Asserts
+        self.assertEqual('A failure', str(ve.exception))
@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import gzip
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 
 import falcon
-from bson import ObjectId
+from bson import BSON, ObjectId
 
-from smapy.middleware import JSONSerializer, ResponseBuilder, SessionHandler
+from smapy.middleware import (
+    BSON_CONTENT_TYPE, JSON_CONTENT_TYPE, JSONSerializer, ResponseBuilder, SessionHandler)
 
 
 class TestJSONSerializer(TestCase):
@@ -112,6 +114,80 @@ class TestJSONSerializer(TestCase):
         }
         self.assertEqual(body, req.body)
 
+    def test_process_request_bson(self):
+        """If content type is BSON, the body must be decoded as BSON."""
+
+        # Set up
+        req = MagicMock()
+        req.content_length = 100
+        req.content_type = BSON_CONTENT_TYPE
+        req.stream.read.return_value = BSON.encode({'a': ObjectId('57bee205ab17852928644d3e')})
+        resp = MagicMock()
+
+        # Actual call
+        JSONSerializer().process_request(req, resp)
+
+        # Asserts
+        body = {
+            'a': ObjectId('57bee205ab17852928644d3e')
+        }
+        self.assertEqual(body, req.body)
+
+    def test_process_request_malformed_bson(self):
+        """If content type is BSON but body is not a valid BSON an exception must be raised."""
+
+        # Set up
+        req = MagicMock()
+        req.content_length = 100
+        req.content_type = BSON_CONTENT_TYPE
+        req.stream.read.return_value = b'this is not a BSON'
+        resp = MagicMock()
+
+        # Actual call
+        with self.assertRaises(falcon.HTTPBadRequest) as ex:
+            JSONSerializer().process_request(req, resp)
+
+        # Asserts
+        exception = ex.exception
+        self.assertEqual('Malformed BSON', exception.title)
+        self.assertEqual('A valid BSON document is required.', exception.description)
+
+    def test_process_request_gzip(self):
+        """If body is compressed, it must be decompressed before being loaded."""
+
+        # Set up
+        req = MagicMock()
+        req.content_length = 100
+        req.get_header.return_value = 'gzip'
+        req.stream.read.return_value = gzip.compress('{"valid": "JSON"}'.encode('utf-8'))
+        resp = MagicMock()
+
+        # Actual call
+        JSONSerializer().process_request(req, resp)
+
+        # Asserts
+        req.get_header.assert_called_once_with('Content-Encoding')
+        self.assertEqual({'valid': 'JSON'}, req.body)
+
+    def test_process_request_malformed_gzip(self):
+        """If body cannot be decompressed, an exception must be raised."""
+
+        # Set up
+        req = MagicMock()
+        req.content_length = 100
+        req.get_header.return_value = 'gzip'
+        req.stream.read.return_value = b'this is not gzip'
+        resp = MagicMock()
+
+        # Actual call
+        with self.assertRaises(falcon.HTTPBadRequest) as ex:
+            JSONSerializer().process_request(req, resp)
+
+        # Asserts
+        exception = ex.exception
+        self.assertEqual('Malformed body', exception.title)
+        self.assertEqual('Body could not be decompressed.', exception.description)
+
     def test__serial_datetime(self):
         """If obj is a datetime, isoformat it."""
 
@@ -191,9 +267,28 @@ class TestJSONSerializer(TestCase):
         JSONSerializer().process_response(req, resp, resource)
 
         # Asserts
-        expected_body = '{\n    "a datetime": {\n        "$date": 946684800000\n    }\n}'
+        expected_body = '{"a datetime": {"$date": 946684800000}}'
         self.assertEqual(expected_body, resp.body)
 
+    def test_process_response_internal_bson(self):
+        """If internal and BSON is preferred, serialize using BSON."""
+
+        # Set up
+        req = MagicMock()
+        req.context = {'internal': True}
+        req.client_prefers.return_value = BSON_CONTENT_TYPE
+        resp = MagicMock()
+        resp.body = {'a datetime': datetime.datetime(2000, 1, 1)}
+        resource = MagicMock()
+
+        # Actual call
+        JSONSerializer().process_response(req, resp, resource)
+
+        # Asserts
+        expected_body = BSON.encode({'a datetime': datetime.datetime(2000, 1, 1)})
+        self.assertEqual(expected_body, resp.body)
+        self.assertEqual(BSON_CONTENT_TYPE, resp.content_type)
+
     def test_process_response_external(self):
         """If not internal, serialize using the custom serializer."""
 
@@ -211,6 +306,64 @@ class TestJSONSerializer(TestCase):
         expected_body = '{\n    "a datetime": "2000-01-01T00:00:00"\n}'
         self.assertEqual(expected_body, resp.body)
 
+    def test_process_response_compressed(self):
+        """If the body is big enough and gzip is accepted, compress it."""
+
+        # Set up
+        req = MagicMock()
+        req.context = {'internal': False}
+        req.get_header.return_value = 'gzip, deflate'
+        resp = MagicMock()
+        resp.body = {'a': 'value'}
+        resource = MagicMock()
+
+        # Actual call
+        JSONSerializer(compress_min_size=10).process_response(req, resp, resource)
+
+        # Asserts
+        req.get_header.assert_called_once_with('Accept-Encoding')
+        expected_body = '{\n    "a": "value"\n}'
+        self.assertEqual(expected_body, gzip.decompress(resp.body).decode('utf-8'))
+        resp.set_header.assert_called_once_with('Content-Encoding', 'gzip')
+        resp.append_header.assert_called_once_with('Vary', 'Accept-Encoding')
+
+    def test_process_response_not_compressed_small(self):
+        """If the body is smaller than compress_min_size, do not compress it."""
+
+        # Set up
+        req = MagicMock()
+        req.context = {'internal': False}
+        req.get_header.return_value = 'gzip, deflate'
+        resp = MagicMock()
+        resp.body = {'a': 'value'}
+        resource = MagicMock()
+
+        # Actual call
+        JSONSerializer(compress_min_size=1024).process_response(req, resp, resource)
+
+        # Asserts
+        self.assertEqual('{\n    "a": "value"\n}', resp.body)
+        self.assertEqual(0, resp.set_header.call_count)
+
+    def test_process_response_not_compressed_identity(self):
+        """Internal requests which only accept identity get an uncompressed response."""
+
+        # Set up
+        req = MagicMock()
+        req.context = {'internal': True}
+        req.client_prefers.return_value = JSON_CONTENT_TYPE
+        req.get_header.return_value = 'identity'
+        resp = MagicMock()
+        resp.body = {'a': 'value'}
+        resource = MagicMock()
+
+        # Actual call
+        JSONSerializer(compress_min_size=10).process_response(req, resp, resource)
+
+        # Asserts
+        self.assertEqual('{"a": "value"}', resp.body)
+        self.assertEqual(0, resp.set_header.call_count)
+
 
 class TestResponseBuilder(TestCase):
 
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from smapy.peers import CircuitBreaker, Peer, PeerSet, PeerUnavailable
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_record_opens(self):
+        """If the error rate reaches the threshold, the breaker opens."""
+
+        breaker = CircuitBreaker(error_rate=0.5, min_requests=4)
+        for failed in (False, True, False):
+            breaker.record(failed)
+
+        self.assertTrue(breaker.allow())
+
+        breaker.record(True)
+
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+
+    def test_record_slow(self):
+        """Requests slower than the slow threshold count as failed."""
+
+        breaker = CircuitBreaker(error_rate=1, slow=1, min_requests=2)
+        breaker.record(False, 2)
+        breaker.record(False, 3)
+
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+
+    @patch('smapy.peers.time')
+    def test_half_open_probe(self, time_mock):
+        """After the cooldown a single probe is allowed, which closes or reopens the breaker."""
+
+        # Set up
+        time_mock.monotonic.return_value = 100
+        breaker = CircuitBreaker(min_requests=1, cooldown=5)
+        breaker.record(True)
+
+        # Still cooling down
+        time_mock.monotonic.return_value = 104
+        self.assertFalse(breaker.allow())
+
+        # Half open: only one probe
+        time_mock.monotonic.return_value = 105
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.acquire())
+        self.assertFalse(breaker.allow())
+
+        # The probe fails: open again
+        breaker.record(True, probe=True)
+        breaker.release()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+
+        # The next probe succeeds: closed
+        time_mock.monotonic.return_value = 110
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.acquire())
+        breaker.record(False, 0.1, probe=True)
+        breaker.release()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+
+    @patch('smapy.peers.time')
+    def test_half_open_probe_expired(self, time_mock):
+        """A probe which is claimed but never sent does not block the breaker forever."""
+
+        # Set up
+        time_mock.monotonic.return_value = 100
+        breaker = CircuitBreaker(min_requests=1, cooldown=5)
+        breaker.record(True)
+
+        time_mock.monotonic.return_value = 105
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.acquire())
+
+        # Actual call
+        time_mock.monotonic.return_value = 109
+        still_probing = not breaker.allow()
+        time_mock.monotonic.return_value = 110
+
+        # Asserts
+        self.assertTrue(still_probing)
+        self.assertTrue(breaker.allow())
+
+
+class TestPeer(TestCase):
+
+    def test_percentile_not_enough_samples(self):
+        """If there are not enough latencies recorded, return None."""
+
+        peer = Peer('http://an_endpoint')
+        peer.latencies.extend([1] * (Peer.MIN_SAMPLES - 1))
+
+        self.assertIsNone(peer.percentile(50))
+
+    def test_percentile(self):
+        """Return the requested latency percentile."""
+
+        peer = Peer('http://an_endpoint')
+        peer.latencies.extend(range(11))
+
+        self.assertEqual(5, peer.percentile(50))
+        self.assertEqual(10, peer.percentile(100))
+
+
+class TestPeerSet(TestCase):
+
+    def test___init__no_endpoints(self):
+        """At least one endpoint is required."""
+
+        with self.assertRaises(ValueError):
+            PeerSet([])
+
+    def test___init__invalid_routing(self):
+        """The routing must be one of the supported ones."""
+
+        with self.assertRaises(ValueError) as ve:
+            PeerSet(['http://an_endpoint'], 'invalid')
+
+        self.assertEqual('Invalid routing: invalid', str(ve.exception))
+
+    def test_choose_least_outstanding(self):
+        """The peer with less requests in flight must be chosen."""
+
+        # Set up
+        peer_set = PeerSet(['http://one', 'http://two', 'http://three'])
+        peer_set.peers[0].in_flight = 3
+        peer_set.peers[1].in_flight = 1
+        peer_set.peers[2].in_flight = 2
+
+        # Actual call
+        peer = peer_set.choose()
+
+        # Asserts
+        self.assertEqual('http://two', peer.endpoint)
+
+    def test_choose_power_of_two(self):
+        """The busiest peer must never be chosen out of two."""
+
+        # Set up
+        peer_set = PeerSet(['http://one', 'http://two'], 'power_of_two')
+        peer_set.peers[0].in_flight = 3
+
+        # Actual call
+        peers = {peer_set.choose().endpoint for _ in range(10)}
+
+        # Asserts
+        self.assertEqual({'http://two'}, peers)
+
+    def test_choose_exclude(self):
+        """Excluded peers must not be chosen unless there is no other option."""
+
+        # Set up
+        peer_set = PeerSet(['http://one', 'http://two'])
+        one, two = peer_set.peers
+        two.in_flight = 3
+
+        # Actual call
+        peer = peer_set.choose(exclude=[one])
+        other_peer = peer_set.choose(exclude=[one, two])
+
+        # Asserts
+        self.assertEqual(two, peer)
+        self.assertEqual(one, other_peer)
+
+    def test_choose_skips_open_breakers(self):
+        """Peers with an open breaker are not chosen, and if all are open raise an exception."""
+
+        # Set up
+        peer_set = PeerSet(['http://one', 'http://two'], breaker={'min_requests': 1})
+        one, two = peer_set.peers
+        one.failure()
+
+        # Actual call
+        peer = peer_set.choose()
+        two.failure()
+
+        # Asserts
+        self.assertEqual(two, peer)
+        with self.assertRaises(PeerUnavailable):
+            peer_set.choose()
+
+    def test_track_failure(self):
+        """Requests which raise an exception count as failed."""
+
+        # Set up
+        peer_set = PeerSet(['http://one'], breaker={'min_requests': 1})
+        peer = peer_set.choose()
+
+        # Actual call
+        with self.assertRaises(ValueError):
+            with peer_set.track(peer):
+                raise ValueError()
+
+        # Asserts
+        self.assertEqual(0, peer.in_flight)
+        self.assertFalse(peer.available())
+
+    def test_track_cancelled(self):
+        """Cancelled requests do not count as failed, but keep their elapsed time."""
+
+        # Set up
+        peer_set = PeerSet(['http://one'], breaker={'min_requests': 1})
+        peer = peer_set.choose()
+
+        # Actual call
+        with self.assertRaises(KeyboardInterrupt):
+            with peer_set.track(peer):
+                raise KeyboardInterrupt()
+
+        # Asserts
+        self.assertEqual(0, peer.in_flight)
+        self.assertTrue(peer.available())
+        self.assertEqual(1, len(peer.latencies))
+
+    def test_track(self):
+        """The peer counts the request as in flight only within the context."""
+
+        # Set up
+        peer_set = PeerSet(['http://one'])
+        peer = peer_set.choose()
+
+        # Actual call
+        with peer_set.track(peer):
+            in_flight = peer.in_flight
+
+        # Asserts
+        self.assertEqual(1, in_flight)
+        self.assertEqual(0, peer.in_flight)
+        self.assertEqual(1, len(peer.latencies))
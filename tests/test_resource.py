@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from unittest import TestCase
-from unittest.mock import Mock, call, patch
+from unittest.mock import ANY, Mock, call, patch
 
 import falcon
+import gevent
 from bson import ObjectId
 
+from smapy.capture import SessionCapture
 from smapy.resource import BaseResource
 
 
@@ -104,6 +106,64 @@ class TestBaseResource(TestCase):
         response = test_resource.run_local({})
         self.assertEqual('response', response)
 
+    # ###################################
+    # start_session(cls, request, sync) #
+    # ###################################
+    def _get_session_resource(self):
+        class TestResource(BaseResource):
+
+            name = 'test_resource'
+
+            def process(self, message):
+                return 'response'
+
+        api = Mock(endpoint='http://an_endpoint', session_capture=SessionCapture())
+        TestResource.init(api, '/a_route')
+        return TestResource
+
+    def test_start_session_sync(self):
+        """Sync sessions are inserted right away."""
+
+        # Set up
+        resource_class = self._get_session_resource()
+        a_request = Mock(env={}, body={}, params={}, context={'in_ts': 'an_in_ts'})
+
+        # Actual call
+        resource_class.start_session(a_request, True)
+
+        # Asserts
+        session = a_request.context['session']
+        self.assertIsInstance(session, ObjectId)
+        insert = resource_class.mongodb.session.insert
+        insert.assert_called_once_with(ANY)
+        self.assertEqual(session, insert.call_args[0][0]['_id'])
+        self.assertNotIn('pending_session', a_request.context)
+
+    def test_start_session_async(self):
+        """Async sessions get their id right away and are inserted by the greenlet."""
+
+        # Set up
+        resource_class = self._get_session_resource()
+        a_request = Mock(env={}, body={}, params={}, context={'in_ts': 'an_in_ts'})
+
+        # Actual call
+        resource_class.start_session(a_request, False)
+
+        # Asserts
+        resource_class.mongodb.session.insert.assert_not_called()
+        pending_session = a_request.context['pending_session']
+        self.assertEqual(a_request.context['session'], pending_session['_id'])
+
+        # Actual call
+        resource = resource_class(a_request)
+        resource.end_session = Mock()
+        response = resource._run_public({})
+
+        # Asserts
+        self.assertEqual('response', response)
+        resource_class.mongodb.session.insert.assert_called_once_with(pending_session)
+        self.assertNotIn('pending_session', a_request.context)
+
     # ################################
     # on_get(cls, request, response) #
     # ################################
@@ -237,6 +297,48 @@ class TestBaseResource(TestCase):
         # run method thas NOT been called directly
         self.assertEqual(0, other_resource.run.call_count)
 
+    @patch('smapy.resource.Pool')
+    @patch('smapy.resource.gevent')
+    def test__run_one_remote_batches(self, gevent_mock, pool_class_mock):
+        """If remote and remote_batch_size > 1, messages are sent in batches."""
+
+        # Set up
+        class OneResource(BaseResource):
+
+            def process(self, message):
+                pass
+
+        api = Mock()
+        api.endpoint = 'http://an_endpoint'
+        api.conf = {'api': {'remote_batch_size': 2}}
+        OneResource.init(api, 'one_route')
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_request = Mock(context={'session': session})
+        one_resource = OneResource(a_request)
+
+        other_resource = Mock()
+        one_resource._get_runnable = Mock(return_value=other_resource)
+
+        pool_mock = Mock()
+        pool_mock.spawn.side_effect = ['g1', 'g2']
+        pool_class_mock.return_value = pool_mock
+
+        # Actual call
+        messages = [{'message': 1}, {'message': 2}, {'message': 3}]
+        one_resource._run_one('other_resource', messages, 3, True)
+
+        # Asserts
+        pool_class_mock.assert_called_once_with(3)
+
+        expected_calls = [
+            call(other_resource.run_batch, [{'message': 1}, {'message': 2}], None),
+            call(other_resource.run_batch, [{'message': 3}], None),
+        ]
+        self.assertEqual(expected_calls, pool_mock.spawn.call_args_list)
+
+        gevent_mock.wait.assert_called_once_with(['g1', 'g2'])
+
     def test__run_one_single(self):
         """If message is not a list just pass it to the runnable._run method once."""
 
@@ -444,3 +546,90 @@ class TestBaseResource(TestCase):
         # Asserts
         self.assertEqual(0, one_resource._run_many.call_count)
         one_resource._run_one.assert_called_once_with(runnable, message, 1, True, None)
+
+    # #######################################################################
+    # invoke_iter(self, runnable, messages, concurrency=None, remote=False) #
+    # #######################################################################
+    def _get_iter_resource(self, conf=None):
+        class OneResource(BaseResource):
+
+            def process(self, message):
+                pass
+
+        api = Mock(endpoint='http://an_endpoint', conf=conf or {'api': {}})
+        OneResource.init(api, 'one_route')
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_request = Mock(context={'session': session})
+        return OneResource(a_request)
+
+    def test_invoke_iter(self):
+        """The messages are yielded as soon as their runnable finishes."""
+
+        # Set up
+        one_resource = self._get_iter_resource()
+
+        def run(message, remote):
+            gevent.sleep(message['delay'])
+            message['done'] = True
+
+        runnable = Mock()
+        runnable.run.side_effect = run
+        one_resource._get_runnable = Mock(return_value=runnable)
+
+        # Actual call
+        messages = [{'delay': 0.03}, {'delay': 0.01}, {'delay': 0.02}]
+        results = list(one_resource.invoke_iter('a_runnable', messages, 3))
+
+        # Asserts
+        expected = [
+            {'delay': 0.01, 'done': True},
+            {'delay': 0.02, 'done': True},
+            {'delay': 0.03, 'done': True}
+        ]
+        self.assertEqual(expected, results)
+        self.assertIs(messages[1], results[0])
+        one_resource._get_runnable.assert_called_with('a_runnable')
+
+    def test_invoke_iter_batches(self):
+        """When running remotely in batches, the messages of each batch are yielded together."""
+
+        # Set up
+        one_resource = self._get_iter_resource({'api': {'remote_batch_size': 2}})
+        runnable = Mock()
+        one_resource._get_runnable = Mock(return_value=runnable)
+
+        # Actual call
+        messages = [{'message': 1}, {'message': 2}, {'message': 3}]
+        results = list(one_resource.invoke_iter('a_runnable', iter(messages), 2, remote=True))
+
+        # Asserts
+        self.assertEqual(messages, results)
+        calls = [call([{'message': 1}, {'message': 2}]), call([{'message': 3}])]
+        self.assertEqual(calls, runnable.run_batch.call_args_list)
+        runnable.run.assert_not_called()
+
+    def test_invoke_iter_stop(self):
+        """If the iteration is stopped early, the pending messages are cancelled."""
+
+        # Set up
+        one_resource = self._get_iter_resource()
+
+        def run(message, remote):
+            gevent.sleep(message['delay'])
+            message['done'] = True
+
+        runnable = Mock()
+        runnable.run.side_effect = run
+        one_resource._get_runnable = Mock(return_value=runnable)
+
+        # Actual call
+        messages = [{'delay': 0.01}, {'delay': 0.05}]
+        results = one_resource.invoke_iter('a_runnable', messages, 2)
+        first = next(results)
+        results.close()
+        gevent.sleep(0.1)
+
+        # Asserts
+        self.assertIs(messages[0], first)
+        self.assertNotIn('done', messages[1])
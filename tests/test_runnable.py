@@ -2,13 +2,18 @@
 
 import copy
 import datetime
+import gzip
 import json
 from unittest import TestCase
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
 
 import falcon
-from bson import ObjectId
+import gevent
+import requests
+from bson import BSON, ObjectId
+from pymongo.errors import ConnectionFailure, OperationFailure
 
+from smapy.middleware import BSON_CONTENT_TYPE
 from smapy.runnable import RemoteRunnable, Runnable, RunnableMeta
 
 
@@ -39,7 +44,7 @@ class TestRunnableMeta(TestCase):
 class TestRemoteRunnable(TestCase):
 
     def setUp(self):
-        self.api = MagicMock(endpoint='http://host:port')
+        self.api = MagicMock(endpoint='http://host:port', conf={'api': {}})
 
     # ################
     # init(cls, api) #
@@ -49,15 +54,37 @@ class TestRemoteRunnable(TestCase):
 
         api = MagicMock()
         api.endpoint = 'http://an_endpoint'
+        api.conf = {'api': {}}
         RemoteRunnable.init(api)
 
         # validate the attribute values of the class
         self.assertEqual(api, RemoteRunnable.api)
         self.assertEqual(api.mongodb, RemoteRunnable.mongodb)
-        self.assertEqual('http://an_endpoint/_remote', RemoteRunnable.endpoint)
         self.assertEqual(RemoteRunnable.__name__, RemoteRunnable.name)
         self.assertEqual(RemoteRunnable.name, RemoteRunnable.logger.name)
 
+        # without remote_endpoints, the only peer is the API itself
+        endpoints = [peer.endpoint for peer in RemoteRunnable.peers.peers]
+        self.assertEqual(['http://an_endpoint/_remote'], endpoints)
+
+    def test_init_remote_endpoints(self):
+        """If remote_endpoints are given, a peer is created for each one of them."""
+
+        api = MagicMock()
+        api.endpoint = 'http://an_endpoint'
+        api.conf = {
+            'api': {
+                'remote_endpoints': ['http://one_endpoint', 'http://other_endpoint'],
+                'remote_routing': 'power_of_two'
+            }
+        }
+        RemoteRunnable.init(api)
+
+        endpoints = [peer.endpoint for peer in RemoteRunnable.peers.peers]
+        expected_endpoints = ['http://one_endpoint/_remote', 'http://other_endpoint/_remote']
+        self.assertEqual(expected_endpoints, endpoints)
+        self.assertEqual('power_of_two', RemoteRunnable.peers.routing)
+
     # ##########################
     # __init__(self, runnable) #
     # ##########################
@@ -66,6 +93,7 @@ class TestRemoteRunnable(TestCase):
 
         api = MagicMock()
         api.endpoint = 'http://an_endpoint'
+        api.conf = {'api': {}}
         RemoteRunnable.init(api)
 
         a_runnable = MagicMock()
@@ -75,7 +103,6 @@ class TestRemoteRunnable(TestCase):
         # validate the attribute values of the class
         self.assertEqual(api, RemoteRunnable.api)
         self.assertEqual(api.mongodb, RemoteRunnable.mongodb)
-        self.assertEqual('http://an_endpoint/_remote', RemoteRunnable.endpoint)
         self.assertEqual(RemoteRunnable.__name__, RemoteRunnable.name)
         self.assertEqual(RemoteRunnable.name, RemoteRunnable.logger.name)
 
@@ -150,7 +177,10 @@ class TestRemoteRunnable(TestCase):
         self.assertEqual(len(call_kwargs), 2)
 
         self.assertTrue('headers' in call_kwargs)
-        expected_headers = {'API-SESSION': '57b599f8ab1785652bb879a7'}
+        expected_headers = {
+            'API-SESSION': '57b599f8ab1785652bb879a7',
+            'Accept-Encoding': 'identity'
+        }
         self.assertEqual(expected_headers, call_kwargs['headers'])
 
         self.assertTrue('data' in call_kwargs)
@@ -160,6 +190,177 @@ class TestRemoteRunnable(TestCase):
         call_data_dict = json.loads(call_data)
         self.assertEqual(expected_data, call_data_dict)
 
+    @patch('smapy.runnable.requests')
+    def test_run_bson(self, requests_mock):
+        """If remote_format is bson, message should be POSTed and read back as BSON."""
+        now = datetime.datetime(2000, 1, 1)
+        message = {
+            'a_string': 'a string',
+            'a_datetime': now
+        }
+
+        # Set up
+        content = BSON.encode({
+            'results': {
+                'message': {
+                    'a_new_string': 'a new string',
+                }
+            },
+            'status': falcon.HTTP_OK
+        })
+        headers = {'Content-Type': BSON_CONTENT_TYPE}
+        response_mock = MagicMock(status_code=200, content=content, headers=headers)
+        session_mock = MagicMock()
+        session_mock.post.return_value = response_mock
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'remote_format': 'bson'}}
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        remote_runnable.run(message)
+
+        # Asserts
+        call_kwargs = session_mock.post.call_args[1]
+        expected_headers = {
+            'API-SESSION': '57b599f8ab1785652bb879a7',
+            'Accept-Encoding': 'identity',
+            'Content-Type': BSON_CONTENT_TYPE,
+            'Accept': BSON_CONTENT_TYPE
+        }
+        self.assertEqual(expected_headers, call_kwargs['headers'])
+
+        expected_data = {
+            'message': {
+                'a_string': 'a string',
+                'a_datetime': now
+            },
+            'runnable': 'a_runnable'
+        }
+        self.assertEqual(expected_data, BSON(call_kwargs['data']).decode())
+
+        expected_message = {
+            'a_string': 'a string',
+            'a_datetime': now,
+            'a_new_string': 'a new string'
+        }
+        self.assertEqual(expected_message, message)
+
+    @patch('smapy.runnable.requests')
+    def test_run_delta(self, requests_mock):
+        """If remote_delta is enabled, ask for the delta and apply it to the message."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {
+                'delta': {
+                    'set': {'a_new_string': 'a new string'},
+                    'unset': ['a_deleted_string']
+                }
+            },
+            'status': falcon.HTTP_OK
+        })
+        response_mock = MagicMock(status_code=200, text=json_text)
+        session_mock = MagicMock()
+        session_mock.post.return_value = response_mock
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'remote_delta': True}}
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        message = {
+            'a_string': 'a string',
+            'a_deleted_string': 'a deleted string'
+        }
+        remote_runnable.run(message)
+
+        # Asserts
+        call_data = json.loads(session_mock.post.call_args[1]['data'])
+        self.assertTrue(call_data['delta'])
+
+        expected_message = {
+            'a_string': 'a string',
+            'a_new_string': 'a new string'
+        }
+        self.assertEqual(expected_message, message)
+
+    @patch('smapy.runnable.requests')
+    def test_run_compressed(self, requests_mock):
+        """If remote_compress is enabled, big requests are sent compressed with gzip."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {'message': {}},
+            'status': falcon.HTTP_OK
+        })
+        response_mock = MagicMock(status_code=200, text=json_text)
+        session_mock = MagicMock()
+        session_mock.post.return_value = response_mock
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'remote_compress': True, 'compress_min_size': 10}}
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        remote_runnable.run({'a': 'message'})
+
+        # Asserts
+        call_kwargs = session_mock.post.call_args[1]
+        self.assertEqual('gzip', call_kwargs['headers']['Content-Encoding'])
+        self.assertEqual('gzip', call_kwargs['headers']['Accept-Encoding'])
+
+        call_data = json.loads(gzip.decompress(call_kwargs['data']).decode('utf-8'))
+        expected_data = {
+            'message': {'a': 'message'},
+            'runnable': 'a_runnable'
+        }
+        self.assertEqual(expected_data, call_data)
+
+    @patch('smapy.runnable.requests')
+    def test_run_not_compressed(self, requests_mock):
+        """If remote_compress is disabled, uncompressed responses are requested."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {'message': {}},
+            'status': falcon.HTTP_OK
+        })
+        session_mock = MagicMock()
+        session_mock.post.return_value = MagicMock(status_code=200, text=json_text)
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'compress_min_size': 10}}
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        remote_runnable.run({'a': 'message'})
+
+        # Asserts
+        headers = session_mock.post.call_args[1]['headers']
+        self.assertEqual('identity', headers['Accept-Encoding'])
+        self.assertNotIn('Content-Encoding', headers)
+
     @patch('smapy.runnable.requests')
     def test_run_wrong_response_not_ok(self, requests_mock):
         """If remote response is not 200 OK and InternalServerError must be raised."""
@@ -223,6 +424,373 @@ class TestRemoteRunnable(TestCase):
         self.assertEqual('RemoteRunnable(a_runnable)', exception.title)
         self.assertEqual('Invalid remote response format', exception.description)
 
+    # ##########################
+    # run_batch(self, messages) #
+    # ##########################
+    @patch('smapy.runnable.requests')
+    def test_run_batch_success(self, requests_mock):
+        """All the messages should be POSTed at once and updated with the response."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {
+                'messages': [
+                    {'a': 'modified 1'},
+                    {'a': 'modified 2'},
+                ]
+            },
+            'status': falcon.HTTP_OK
+        })
+        response_mock = MagicMock(status_code=200, text=json_text)
+        session_mock = MagicMock()
+        session_mock.post.return_value = response_mock
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        messages = [{'a': 1}, {'a': 2}]
+        remote_runnable.run_batch(messages)
+
+        # Asserts
+        self.assertEqual(1, session_mock.post.call_count)
+
+        call_data = json.loads(session_mock.post.call_args[1]['data'])
+        expected_data = {
+            'messages': [{'a': 1}, {'a': 2}],
+            'runnable': 'a_runnable'
+        }
+        self.assertEqual(expected_data, call_data)
+
+        self.assertEqual([{'a': 'modified 1'}, {'a': 'modified 2'}], messages)
+
+    @patch('smapy.runnable.requests')
+    def test_run_batch_wrong_length(self, requests_mock):
+        """If the remote returns a different number of messages, raise an exception."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {
+                'messages': [{'a': 'modified 1'}]
+            },
+            'status': falcon.HTTP_OK
+        })
+        response_mock = MagicMock(status_code=200, text=json_text)
+        session_mock = MagicMock()
+        session_mock.post.return_value = response_mock
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        with self.assertRaises(falcon.HTTPInternalServerError) as ex:
+            remote_runnable.run_batch([{'a': 1}, {'a': 2}])
+
+        # Asserts
+        self.assertEqual('Invalid remote batch size', ex.exception.description)
+
+    @patch('smapy.runnable.requests')
+    def test_run_retry_idempotent(self, requests_mock):
+        """If the runnable is idempotent, failed requests are retried."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {'message': {'a': 'modified'}},
+            'status': falcon.HTTP_OK
+        })
+        response_mock = MagicMock(status_code=200, text=json_text)
+        session_mock = MagicMock()
+        session_mock.post.side_effect = [requests.ConnectionError('Refused'), response_mock]
+        requests_mock.Session.return_value = session_mock
+        requests_mock.RequestException = requests.RequestException
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session, idempotent=True)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'remote_retries': 1, 'remote_backoff': 0}}
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        message = {'a': 'message'}
+        remote_runnable.run(message)
+
+        # Asserts
+        self.assertEqual(2, session_mock.post.call_count)
+        self.assertEqual({'a': 'modified'}, message)
+
+    @patch('smapy.runnable.requests')
+    def test_run_no_retry_not_idempotent(self, requests_mock):
+        """If the runnable is not idempotent, failed requests are not retried."""
+
+        # Set up
+        session_mock = MagicMock()
+        session_mock.post.side_effect = requests.ConnectionError('Refused')
+        requests_mock.Session.return_value = session_mock
+        requests_mock.RequestException = requests.RequestException
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session, idempotent=False)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'remote_retries': 3, 'remote_backoff': 0}}
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        with self.assertRaises(falcon.HTTPInternalServerError) as ex:
+            remote_runnable.run({})
+
+        # Asserts
+        self.assertEqual(1, session_mock.post.call_count)
+        self.assertEqual('Remote request failed: Refused', ex.exception.description)
+
+    @patch('smapy.runnable.requests')
+    def test_run_no_peer_available(self, requests_mock):
+        """If all the peers have their breaker open, fail fast without posting."""
+
+        # Set up
+        session_mock = MagicMock()
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'remote_breaker': True, 'remote_breaker_min_requests': 1}}
+        RemoteRunnable.init(self.api)
+        RemoteRunnable.peers.peers[0].failure()
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        with self.assertRaises(falcon.HTTPServiceUnavailable) as ex:
+            remote_runnable.run({})
+
+        # Asserts
+        self.assertEqual(0, session_mock.post.call_count)
+        self.assertEqual('No remote peer available', ex.exception.description)
+
+    @patch('smapy.runnable.requests')
+    def test_run_retry_unavailable(self, requests_mock):
+        """A 503 response counts as a failure and is retried on another peer."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {'message': {'a': 'modified'}},
+            'status': falcon.HTTP_OK
+        })
+        responses = [
+            MagicMock(status_code=503),
+            MagicMock(status_code=200, text=json_text)
+        ]
+        session_mock = MagicMock()
+        session_mock.post.side_effect = responses
+        requests_mock.Session.return_value = session_mock
+        requests_mock.RequestException = requests.RequestException
+        requests_mock.HTTPError = requests.HTTPError
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session, idempotent=True)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {
+            'api': {
+                'remote_endpoints': ['http://one', 'http://other'],
+                'remote_retries': 1,
+                'remote_backoff': 0,
+                'remote_breaker': True,
+                'remote_breaker_min_requests': 1
+            }
+        }
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        message = {}
+        remote_runnable.run(message)
+
+        # Asserts
+        endpoints = [call_args[0][0] for call_args in session_mock.post.call_args_list]
+        self.assertEqual(2, len(set(endpoints)))
+        self.assertEqual({'a': 'modified'}, message)
+
+        available = [peer.available() for peer in RemoteRunnable.peers.peers]
+        self.assertEqual(1, sum(available))
+
+    @patch('smapy.runnable.requests')
+    def test_run_hedged(self, requests_mock):
+        """If a request is slower than usual, it is hedged and the fastest response wins."""
+
+        # Set up
+        def post_side_effect(endpoint, data, headers):
+            if post_mock.call_count == 1:
+                gevent.sleep(10)
+                message = {'a': 'slow'}
+
+            else:
+                message = {'a': 'fast'}
+
+            json_text = json.dumps({
+                'results': {'message': message},
+                'status': falcon.HTTP_OK
+            })
+            return MagicMock(status_code=200, text=json_text)
+
+        post_mock = MagicMock(side_effect=post_side_effect)
+        session_mock = MagicMock(post=post_mock)
+        requests_mock.Session.return_value = session_mock
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session, idempotent=True)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {
+            'api': {
+                'remote_endpoints': ['http://one', 'http://other'],
+                'remote_hedge_percentile': 95
+            }
+        }
+        RemoteRunnable.init(self.api)
+        for peer in RemoteRunnable.peers.peers:
+            peer.latencies.extend([0.01] * 10)
+
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        message = {'a': 'message'}
+        remote_runnable.run(message)
+
+        # Asserts
+        self.assertEqual(2, post_mock.call_count)
+        endpoints = {call_args[0][0] for call_args in post_mock.call_args_list}
+        self.assertEqual({'http://one/_remote', 'http://other/_remote'}, endpoints)
+        self.assertEqual({'a': 'fast'}, message)
+        self.assertEqual([0, 0], [peer.in_flight for peer in RemoteRunnable.peers.peers])
+
+        # The cancelled slow request also keeps its latency
+        self.assertEqual([11, 11], [len(peer.latencies) for peer in RemoteRunnable.peers.peers])
+
+    @patch('smapy.runnable.requests')
+    def test_run_hedged_half_open(self, requests_mock):
+        """A half open peer only gets a single probe, even when hedging concurrently."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {'message': {'a': 'modified'}},
+            'status': falcon.HTTP_OK
+        })
+
+        def post_side_effect(endpoint, data, headers):
+            gevent.sleep(0.05)
+            return MagicMock(status_code=200, text=json_text)
+
+        post_mock = MagicMock(side_effect=post_side_effect)
+        requests_mock.Session.return_value = MagicMock(post=post_mock)
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session, idempotent=True)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {
+            'api': {
+                'remote_endpoints': ['http://one', 'http://other'],
+                'remote_hedge_percentile': 95,
+                'remote_breaker': True
+            }
+        }
+        RemoteRunnable.init(self.api)
+        one, other = RemoteRunnable.peers.peers
+        for peer in (one, other):
+            peer.latencies.extend([0.01] * 10)
+
+        one.breaker.state = one.breaker.HALF_OPEN
+        other.in_flight = 1    # Make one the preferred peer
+
+        # Actual call
+        greenlets = [gevent.spawn(RemoteRunnable(a_runnable).run, {}) for _ in range(3)]
+        gevent.joinall(greenlets, raise_error=True)
+
+        # Asserts
+        endpoints = [call_args[0][0] for call_args in post_mock.call_args_list]
+        self.assertEqual(1, endpoints.count('http://one/_remote'))
+        self.assertEqual(one.breaker.CLOSED, one.breaker.state)
+
+    @patch('smapy.runnable.requests')
+    def test_run_hedged_single_peer(self, requests_mock):
+        """If there is no other peer, the request is not hedged."""
+
+        # Set up
+        json_text = json.dumps({
+            'results': {'message': {'a': 'slow'}},
+            'status': falcon.HTTP_OK
+        })
+
+        def post_side_effect(endpoint, data, headers):
+            gevent.sleep(0.05)
+            return MagicMock(status_code=200, text=json_text)
+
+        post_mock = MagicMock(side_effect=post_side_effect)
+        requests_mock.Session.return_value = MagicMock(post=post_mock)
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session, idempotent=True)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {
+            'api': {
+                'remote_endpoints': ['http://one'],
+                'remote_hedge_percentile': 95
+            }
+        }
+        RemoteRunnable.init(self.api)
+        RemoteRunnable.peers.peers[0].latencies.extend([0.01] * 10)
+
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        message = {'a': 'message'}
+        remote_runnable.run(message)
+
+        # Asserts
+        post_mock.assert_called_once_with('http://one/_remote', data=ANY, headers=ANY)
+        self.assertEqual({'a': 'slow'}, message)
+
+    @patch('smapy.runnable.requests')
+    def test_run_deadline_exceeded(self, requests_mock):
+        """If the remote call lasts more than remote_timeout, a GatewayTimeout is raised."""
+
+        # Set up
+        session_mock = MagicMock()
+        session_mock.post.side_effect = lambda *args, **kwargs: gevent.sleep(10)
+        requests_mock.Session.return_value = session_mock
+        requests_mock.RequestException = requests.RequestException
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        a_runnable = MagicMock(session=session)
+        a_runnable.name = 'a_runnable'
+
+        self.api.conf = {'api': {'remote_timeout': 0.01}}
+        RemoteRunnable.init(self.api)
+        remote_runnable = RemoteRunnable(a_runnable)
+
+        # Actual call
+        with self.assertRaises(falcon.HTTPGatewayTimeout) as ex:
+            remote_runnable.run({})
+
+        # Asserts
+        self.assertEqual('Remote deadline exceeded', ex.exception.description)
+
     # #########################
     # on_post(cls, req, resp) #
     # #########################
@@ -282,6 +850,92 @@ class TestRemoteRunnable(TestCase):
         }
         self.assertEqual(expected_body, resp.body)
 
+    def test_on_post_batch(self):
+        """If messages are given, run each one of them and return them all."""
+
+        # Set mocks up
+        def run_local_side_effect(message):
+            message['a'] = message['a'] * 10
+
+        runnable_mock = MagicMock()
+        runnable_mock.run_local.side_effect = run_local_side_effect
+        runnable_class_mock = MagicMock(return_value=runnable_mock)
+        self.api.runnables = {
+            'a_runnable': runnable_class_mock
+        }
+        self.api.conf = {'api': {'concurrency': 2}}
+
+        # Actual call
+        body = {
+            'messages': [{'a': 1}, {'a': 2}, {'a': 3}],
+            'runnable': 'a_runnable'
+        }
+        req = MagicMock(body=body)
+        req.headers = {'API-SESSION': '57b599f8ab1785652bb879a7'}
+        resp = MagicMock()
+
+        RemoteRunnable.init(self.api)
+        RemoteRunnable.on_post(req, resp)
+
+        # Asserts
+        self.assertEqual(3, runnable_mock.run_local.call_count)
+
+        expected_body = {
+            'messages': [{'a': 10}, {'a': 20}, {'a': 30}],
+            'runnable': 'a_runnable'
+        }
+        self.assertEqual(expected_body, resp.body)
+
+    def test_on_post_delta(self):
+        """If delta is requested, only return the changes done to the message."""
+
+        # Set mocks up
+        def run_local_side_effect(message):
+            self.run_local_message = message
+            message['a'] = 'value'
+            message['a_list'].append(2)
+            del message['a_deleted_string']
+
+        runnable_mock = MagicMock()
+        runnable_mock.run_local.side_effect = run_local_side_effect
+        runnable_class_mock = MagicMock(return_value=runnable_mock)
+        self.api.runnables = {
+            'a_runnable': runnable_class_mock
+        }
+
+        # Actual call
+        body = {
+            'message': {
+                'a_string': 'a string',
+                'a_deleted_string': 'a deleted string',
+                'a_list': [1]
+            },
+            'runnable': 'a_runnable',
+            'delta': True
+        }
+        req = MagicMock(body=body)
+        req.headers = {'API-SESSION': '57b599f8ab1785652bb879a7'}
+        resp = MagicMock()
+
+        RemoteRunnable.init(self.api)
+        RemoteRunnable.on_post(req, resp)
+
+        # Asserts
+        expected_body = {
+            'delta': {
+                'set': {
+                    'a': 'value',
+                    'a_list': [1, 2]
+                },
+                'unset': ['a_deleted_string']
+            },
+            'runnable': 'a_runnable'
+        }
+        self.assertEqual(expected_body, resp.body)
+
+        # Only the values read by the runnable were copied
+        self.assertEqual(['a_list'], list(self.run_local_message.copies))
+
     def test_on_post_missing_param(self):
         """If a param is missing it raises an exception."""
 
@@ -389,3 +1043,94 @@ class TestRunnable(TestCase):
         remote_runnable_mock.run.assert_called_once_with(message)
 
         self.assertEqual(0, test_runnable.run_local.call_count)
+
+    def test_check_session_alive_not_alive(self):
+        """If the session is not alive, raise an exception."""
+
+        # Set up
+        class TestRunnable(Runnable):
+            name = 'test_runnable'
+
+            def run_local(self, message):
+                pass
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        api = MagicMock(conf={'api': {}})
+        api.mongodb.session.find_one.return_value = {'alive': False}
+        TestRunnable.init(api)
+
+        test_runnable = TestRunnable(MagicMock(context={'session': session}))
+
+        # Actual call
+        with self.assertRaises(falcon.HTTPInternalServerError) as ex:
+            test_runnable.check_session_alive()
+
+        # Asserts
+        self.assertEqual('Session 57b599f8ab1785652bb879a7 not alive', ex.exception.description)
+
+    def test_check_session_alive_cached(self):
+        """If session_alive_ttl is set, alive sessions are only queried once until forgotten."""
+
+        # Set up
+        class TestRunnable(Runnable):
+            def run_local(self, message):
+                pass
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        api = MagicMock(conf={'api': {'session_alive_ttl': 60}})
+        api.mongodb.session.find_one.return_value = {'alive': True}
+        TestRunnable.init(api)
+
+        test_runnable = TestRunnable(MagicMock(context={'session': session}))
+
+        # Actual call
+        test_runnable.check_session_alive()
+        test_runnable.check_session_alive()
+
+        TestRunnable.forget_session(session)
+        test_runnable.check_session_alive()
+
+        # Asserts
+        self.assertEqual(2, api.mongodb.session.find_one.call_count)
+
+        TestRunnable.forget_session(session)
+
+    @patch('smapy.runnable.gevent')
+    def test_watch_sessions_create_retried(self, gevent_mock):
+        """Failing to create the session events collection is retried, and if it exists, used."""
+
+        # Set up
+        class StopWatching(Exception):
+            pass
+
+        session = ObjectId('57b599f8ab1785652bb879a7')
+        Runnable._alive_sessions[session] = 0
+
+        mongodb = MagicMock()
+        mongodb.create_collection.side_effect = [
+            ConnectionFailure('Mongo is down'),
+            OperationFailure('Collection already exists', 48),
+        ]
+        events = [{'_id': ObjectId(), 'session': session}]
+        mongodb[Runnable.SESSION_EVENTS].find.return_value = events
+        gevent_mock.sleep.side_effect = [None, StopWatching()]
+
+        # Actual call
+        with self.assertRaises(StopWatching):
+            Runnable.watch_sessions(mongodb)
+
+        # Asserts
+        self.assertEqual(2, mongodb.create_collection.call_count)
+        mongodb[Runnable.SESSION_EVENTS].find.assert_called_once_with(ANY, cursor_type=ANY)
+        self.assertNotIn(session, Runnable._alive_sessions)
+
+    def test_watch_sessions_create_error(self):
+        """Other errors creating the session events collection are raised."""
+
+        # Set up
+        mongodb = MagicMock()
+        mongodb.create_collection.side_effect = OperationFailure('Not authorized', 13)
+
+        # Actual call
+        with self.assertRaises(OperationFailure):
+            Runnable._create_session_events(mongodb)
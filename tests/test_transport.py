@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from smapy.transport import UnixAdapter, UnixHTTPConnectionPool, get_url
+
+
+class TestGetUrl(TestCase):
+
+    def test_get_url_http(self):
+        """HTTP endpoints are left untouched."""
+        self.assertEqual('http://127.0.0.1:8001', get_url('http://127.0.0.1:8001'))
+
+    def test_get_url_unix(self):
+        """Unix endpoints are converted to http+unix URLs."""
+        url = get_url('unix:///tmp/smapy.sock')
+        self.assertEqual('http+unix://%2Ftmp%2Fsmapy.sock', url)
+
+
+class TestUnixAdapter(TestCase):
+
+    def test_get_connection(self):
+        """A single pool is created for each socket path."""
+
+        # Set up
+        adapter = UnixAdapter(pool_maxsize=5, pool_block=True)
+
+        # Actual call
+        pool = adapter.get_connection('http+unix://%2Ftmp%2Fsmapy.sock/_remote')
+        same_pool = adapter.get_connection('http+unix://%2Ftmp%2Fsmapy.sock/other')
+        other_pool = adapter.get_connection('http+unix://%2Ftmp%2Fother.sock/_remote')
+
+        # Asserts
+        self.assertIsInstance(pool, UnixHTTPConnectionPool)
+        self.assertEqual('/tmp/smapy.sock', pool.socket_path)
+        self.assertTrue(pool.block)
+        self.assertIs(pool, same_pool)
+        self.assertEqual('/tmp/other.sock', other_pool.socket_path)
+
+    def test_request_url(self):
+        """Only the path is sent in the request line."""
+
+        adapter = UnixAdapter()
+        request = Mock(path_url='/_remote')
+
+        self.assertEqual('/_remote', adapter.request_url(request, None))
@@ -198,3 +198,72 @@ class TestSetenv(TestCase):
             'another': 'parameter'
         }
         self.assertEqual(expected, os_mock.environ)
+
+
+class TestTrackedDict(TestCase):
+    def test_original_untouched(self):
+        tracked = utils.TrackedDict({'a': [1], 'b': {'c': 2}})
+        self.assertEqual({'a': [1], 'b': {'c': 2}}, tracked.original())
+        self.assertEqual({}, tracked.copies)
+
+    def test_original_modified_in_place(self):
+        tracked = utils.TrackedDict({'a': [1], 'b': {'c': 2}})
+        tracked.get('a').append(3)
+        tracked.setdefault('b', {})['c'] = 4
+        tracked['d'] = 5
+
+        self.assertEqual({'a': [1, 3], 'b': {'c': 4}, 'd': 5}, tracked)
+        self.assertEqual({'a': [1], 'b': {'c': 2}}, tracked.original())
+
+    def test_original_replaced(self):
+        """Values replaced before being read are not copied."""
+        tracked = utils.TrackedDict({'a': [1]})
+        tracked['a'] = [2]
+        tracked['a'].append(3)
+
+        self.assertEqual({'a': [1]}, tracked.original())
+        self.assertEqual({}, tracked.copies)
+
+    def test_original_bulk_access(self):
+        tracked = utils.TrackedDict({'a': [1], 'b': [2]})
+        for value in tracked.values():
+            value.append(3)
+
+        self.assertEqual({'a': [1], 'b': [2]}, tracked.original())
+
+    def test_dict_conversion(self):
+        tracked = utils.TrackedDict({'a': [1]})
+        dict(tracked)['a'].append(2)
+
+        self.assertEqual({'a': [1]}, tracked.original())
+
+    def test_get_delta(self):
+        """Only the changed values are returned, whether modified in place or not."""
+        tracked = utils.TrackedDict({'a': [1], 'b': [2], 'c': 3, 'd': 4, 'e': [5]})
+        tracked['a'].append(2)
+        tracked['b']
+        tracked['c'] = 6
+        del tracked['d']
+        tracked['f'] = 7
+
+        expected = {'set': {'a': [1, 2], 'c': 6, 'f': 7}, 'unset': ['d']}
+        self.assertEqual(expected, tracked.get_delta())
+        self.assertEqual(['a', 'b'], sorted(tracked.copies))
+
+    def test_uncopyable(self):
+        """Values which cannot be copied can still be read, but are not in the original."""
+
+        class Uncopyable(object):
+            def __deepcopy__(self, memo):
+                raise RecursionError('maximum recursion depth exceeded')
+
+        uncopyable = Uncopyable()
+        tracked = utils.TrackedDict({'a': uncopyable, 'b': [1]})
+
+        with self.assertLogs('smapy.utils', 'ERROR'):
+            self.assertIs(uncopyable, tracked['a'])
+
+        self.assertIs(uncopyable, tracked.get('a'))
+        self.assertEqual({'a'}, tracked.uncopyable)
+        self.assertEqual({'b': [1]}, tracked.original())
+        self.assertEqual({'set': {'a': uncopyable}, 'unset': []}, tracked.get_delta())